@@ -0,0 +1,98 @@
+# Compares a sync pymongo handler running in the Starlette threadpool with an AsyncMongoClient handler
+# running on the event loop. Both apps serve the same profile lookup against a throwaway database.
+#
+#   python -m benchmark.async_vs_sync --requests 5000 --concurrency 500
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from bson import ObjectId
+from fastapi import FastAPI
+from pymongo import AsyncMongoClient, MongoClient
+
+from config.settings import settings
+from benchmark.stats import percentile
+
+
+DB_NAME = 'eco_social_benchmark'
+
+
+def build_sync_app(client: MongoClient) -> FastAPI:
+    app = FastAPI()
+    users = client.get_database(DB_NAME).users
+
+    @app.get('/user/{user_id}')
+    def get_user(user_id: str):
+        user = users.find_one({'_id': ObjectId(user_id)}, {'username': 1})
+        return {'username': user['username']}
+
+    return app
+
+
+def build_async_app(client: AsyncMongoClient) -> FastAPI:
+    app = FastAPI()
+    users = client.get_database(DB_NAME).users
+
+    @app.get('/user/{user_id}')
+    async def get_user(user_id: str):
+        user = await users.find_one({'_id': ObjectId(user_id)}, {'username': 1})
+        return {'username': user['username']}
+
+    return app
+
+
+async def drive(app: FastAPI, user_ids: list[str], requests: int, concurrency: int) -> dict[str, float]:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        async def one(i: int):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(f'/user/{user_ids[i % len(user_ids)]}')
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'throughput_rps': requests / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def main(requests: int, concurrency: int, users: int):
+    sync_client: MongoClient = MongoClient(settings.db_uri)
+    async_client: AsyncMongoClient = AsyncMongoClient(settings.db_uri)
+
+    collection = sync_client.get_database(DB_NAME).users
+    collection.drop()
+    user_ids = [str(_id) for _id in collection.insert_many(
+        [{'username': f'bench_user_{i}'} for i in range(users)]
+    ).inserted_ids]
+
+    try:
+        for mode, app in (('sync', build_sync_app(sync_client)), ('async', build_async_app(async_client))):
+            result = await drive(app, user_ids, requests, concurrency)
+            print(f"{mode:>5}: {result['throughput_rps']:8.1f} req/s  "
+                  f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms")
+    finally:
+        sync_client.drop_database(DB_NAME)
+        sync_client.close()
+        await async_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.users))
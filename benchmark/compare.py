@@ -0,0 +1,72 @@
+# Compares two result files of benchmark/scenarios.py. Exits with 1 when a scenario of the candidate is slower than
+# the baseline by more than --threshold percent (lower throughput or higher p95/p99), so it can gate a CI job.
+#
+#   python -m benchmark.compare before.json after.json --threshold 10
+import argparse
+import json
+import sys
+from typing import Any
+
+
+# metric, whether higher is better
+METRICS = (
+    ('throughput_rps', True),
+    ('p50_ms', False),
+    ('p95_ms', False),
+    ('p99_ms', False),
+)
+
+GATED = ('throughput_rps', 'p95_ms', 'p99_ms')
+
+
+def load(path: str) -> dict[str, Any]:
+    with open(path) as results:
+        return json.load(results)
+
+
+def change(baseline: float, candidate: float) -> float:
+    return (candidate - baseline) / baseline * 100 if baseline else 0.0
+
+
+def compare(baseline: dict[str, Any], candidate: dict[str, Any], threshold: float) -> list[str]:
+    regressions = []
+    print(f"{'scenario':<17} {'metric':<15} {'baseline':>10} {'candidate':>10} {'change':>9}")
+
+    for name, before in baseline['scenarios'].items():
+        after = candidate['scenarios'].get(name)
+        if after is None:
+            print(f'{name:<17} missing from the candidate')
+            continue
+
+        for metric, higher_is_better in METRICS:
+            delta = change(before[metric], after[metric])
+            worse = -delta if higher_is_better else delta
+            regressed = metric in GATED and worse > threshold
+            if regressed:
+                regressions.append(f'{name} {metric}')
+            print(f'{name:<17} {metric:<15} {before[metric]:10.2f} {after[metric]:10.2f} {delta:+8.1f}%'
+                  f"{'  REGRESSION' if regressed else ''}")
+
+        if after['errors'] > before['errors']:
+            regressions.append(f'{name} errors')
+            print(f"{name:<17} {'errors':<15} {before['errors']:10d} {after['errors']:10d}  REGRESSION")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed slowdown in percent')
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    for key in ('requests', 'concurrency', 'users', 'feed_timelines_enabled'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print(f"Warning: {key} differs ({baseline['meta'].get(key)} vs {candidate['meta'].get(key)})")
+
+    regressions = compare(baseline, candidate, args.threshold)
+    if regressions:
+        print(f"Regressed by more than {args.threshold:g}%: {', '.join(regressions)}")
+        sys.exit(1)
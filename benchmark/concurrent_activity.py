@@ -0,0 +1,91 @@
+# Concurrent activity creation for a single user: the previous read-modify-write (find_one, compute the streak and
+# points in Python, $set them back) against the atomic pipeline update now used by update_after_activity_creation.
+# Every activity is worth the same points, so any difference between the expected and the stored points is a lost
+# update.
+#
+#   python -m benchmark.concurrent_activity --writes 500 --concurrency 50
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timezone, timedelta
+
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+
+from config.settings import settings
+from model.user_model import activity_creation_update
+from benchmark.stats import percentile
+
+
+DB_NAME = 'eco_social_benchmark'
+POINTS = 100
+
+
+async def read_modify_write(users: AsyncCollection, user_id):
+    user = await users.find_one({'_id': user_id})
+    now = datetime.now(timezone.utc)
+    last = user.get('last_time_on_streak')
+    if last is not None and now - last.replace(tzinfo=timezone.utc) < timedelta(hours=48):
+        streak = user.get('streak', 0) + 1
+    else:
+        streak = 1
+    await users.update_one(
+        {'_id': user_id},
+        {'$set': {'streak': streak, 'last_time_on_streak': now, 'points': user.get('points', 0) + POINTS}}
+    )
+
+
+async def atomic(users: AsyncCollection, user_id):
+    await users.find_one_and_update(
+        {'_id': user_id}, activity_creation_update(POINTS),
+        projection={'username': 1, 'streak': 1}, return_document=ReturnDocument.AFTER
+    )
+
+
+async def run(users: AsyncCollection, write, writes: int, concurrency: int) -> dict[str, float]:
+    user_id = (await users.insert_one({'username': f'bench_{write.__name__}', 'points': 0})).inserted_id
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await write(users, user_id)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(writes)))
+    elapsed = time.perf_counter() - start
+
+    user = await users.find_one({'_id': user_id})
+    latencies.sort()
+    return {
+        'writes_per_second': writes / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'lost_updates': writes - user['points'] // POINTS,
+        'streak': user['streak'],
+    }
+
+
+async def main(writes: int, concurrency: int):
+    client: AsyncMongoClient = AsyncMongoClient(settings.db_uri)
+    users = client.get_database(DB_NAME).users
+    try:
+        for write in (read_modify_write, atomic):
+            result = await run(users, write, writes, concurrency)
+            print(f"{write.__name__:>17}: {result['writes_per_second']:8.1f} writes/s  "
+                  f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+                  f"lost updates {result['lost_updates']}/{writes}  final streak {result['streak']}")
+    finally:
+        await client.drop_database(DB_NAME)
+        await client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.writes, args.concurrency))
@@ -0,0 +1,217 @@
+# Seeded synthetic dataset for the scenario benchmarks (benchmark/scenarios.py), written straight to the database
+# named by DB_NAME (eco_social_benchmark unless set). The same --seed always produces the same data.
+#
+# - friendships follow preferential attachment, so a few users have thousands of friends and most have a handful
+# - activities per user are heavy tailed too, spread over the last --days days with more of them in the evening
+# - every user has a few pending requests to people that aren't friends yet
+#
+# Every user logs in with PASSWORD. With --recommendations the recommendation job runs afterwards, without it
+# the recommendations are computed on request.
+#
+#   python -m benchmark.dataset --users 10000 --seed 1 --drop
+import os
+
+os.environ.setdefault('DB_NAME', 'eco_social_benchmark')
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Any, Iterator
+
+from bson import ObjectId
+
+from config.settings import settings
+from db.session import session
+from db.indexes import sync_indexes
+import model.activity_model as activity_model
+import model.timeline_model as timeline_model
+import model.user_model as user_model
+from job.recommendation_job import run_recommendation_job
+from utils.password_hasher import hash_password
+
+
+PASSWORD = 'benchmark-password'
+
+COLLECTIONS = ('users', 'activities', 'timelines', 'recommendations', 'refresh_tokens', 'images')
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ra', 'ben', 'tor', 'eco', 'an', 'li', 'sa', 'vel', 'zu', 'no', 'gre', 'bud', 'ti')
+
+# relative amount of activities created in each hour of the day
+HOURLY_WEIGHTS = (1, 1, 1, 1, 1, 2, 4, 7, 8, 6, 5, 5, 6, 5, 5, 6, 7, 9, 11, 12, 11, 8, 5, 2)
+
+BATCH_SIZE = 1000
+
+
+def make_username(rng: random.Random, i: int) -> str:
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(i)
+
+
+# Barabási–Albert: every new user befriends `links` existing users picked proportionally to their friend count
+def friend_graph(rng: random.Random, users: int, links: int) -> list[set[int]]:
+    friends: list[set[int]] = [set() for _ in range(users)]
+    endpoints: list[int] = []  # every user appears once per friendship
+
+    for user in range(users):
+        if endpoints:
+            for friend in {rng.choice(endpoints) for _ in range(links)}:
+                friends[user].add(friend)
+                friends[friend].add(user)
+                endpoints += (user, friend)
+        elif user > 0:
+            friends[user].add(0)
+            friends[0].add(user)
+            endpoints += (user, 0)
+
+    return friends
+
+
+def random_time(rng: random.Random, now: datetime, days: int) -> datetime:
+    day = now - timedelta(days=rng.randrange(days))
+    hour = rng.choices(range(24), HOURLY_WEIGHTS)[0]
+    created_at = day.replace(hour=hour, minute=rng.randrange(60), second=rng.randrange(60), microsecond=0)
+    return min(created_at, now)
+
+
+def activities_of(
+        rng: random.Random, user_id: ObjectId, username: str, mean: float, now: datetime, days: int
+) -> list[dict[str, Any]]:
+    # Pareto with shape 2 has mean 2, scaled to the requested mean
+    amount = int(rng.paretovariate(2) * mean / 2)
+    activity_types = list(activity_model.ActivityType)
+
+    activities = []
+    for created_at in sorted(random_time(rng, now, days) for _ in range(amount)):
+        activity_type = rng.choice(activity_types)
+        activities.append({
+            'user_id': user_id,
+            'username': username,
+            'activity_type': int(activity_type),
+            'title': f'{activity_type.name.replace("_", " ").capitalize()} #{len(activities) + 1}',
+            'caption': rng.choice(('', 'Every bit counts', 'Done before work', 'With the kids')),
+            'created_at': created_at,
+            'streak_snapshot': rng.randrange(30),
+            'points_gained': activity_model.activity_points.get(activity_type) or 0,
+            'images': [],
+            'image_variants': []
+        })
+    return activities
+
+
+def pending_requests(
+        rng: random.Random, users: int, friends: list[set[int]], per_user: int
+) -> Iterator[tuple[int, int]]:
+    taken = set()
+    for sender in range(users):
+        for _ in range(per_user):
+            receiver = rng.randrange(users)
+            pair = (min(sender, receiver), max(sender, receiver))
+            if receiver != sender and receiver not in friends[sender] and pair not in taken:
+                taken.add(pair)
+                yield sender, receiver
+
+
+async def insert_batches(collection, documents: list[dict[str, Any]]):
+    for start in range(0, len(documents), BATCH_SIZE):
+        await collection.insert_many(documents[start:start + BATCH_SIZE], ordered=False)
+
+
+async def generate(
+        users: int, seed: int, links: int, activities_per_user: float, days: int, requests_per_user: int
+) -> dict[str, int]:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+
+    ids = [ObjectId() for _ in range(users)]
+    usernames = [make_username(rng, i) for i in range(users)]
+    friends = friend_graph(rng, users, links)
+    password_hash = hash_password(PASSWORD)  # bcrypt is slow on purpose, every user gets the same hash
+
+    activities = []
+    for i in range(users):
+        activities += activities_of(rng, ids[i], usernames[i], activities_per_user, now, days)
+
+    documents = [{
+        '_id': ids[i],
+        'username': usernames[i],
+        'password_hash': password_hash,
+        **user_model.search_fields(usernames[i]),
+        'streak': rng.randrange(30),
+        'points': 0,
+        'profile_pic': '',
+        'about_me': '',
+        'friends': [ids[friend] for friend in sorted(friends[i])],
+        'friend_count': len(friends[i]),
+        'activity_count': 0,
+        'incoming_requests': [],
+        'outgoing_requests': []
+    } for i in range(users)]
+
+    by_id = {document['_id']: document for document in documents}
+    for activity in activities:
+        by_id[activity['user_id']]['points'] += activity['points_gained']
+        by_id[activity['user_id']]['activity_count'] += 1
+
+    requests = 0
+    for sender, receiver in pending_requests(rng, users, friends, requests_per_user):
+        sent_at = random_time(rng, now, 14)
+        documents[sender]['outgoing_requests'].append(
+            {'user_id': ids[receiver], 'username': usernames[receiver], 'sent_at': sent_at}
+        )
+        documents[receiver]['incoming_requests'].append(
+            {'user_id': ids[sender], 'username': usernames[sender], 'sent_at': sent_at}
+        )
+        requests += 1
+
+    await insert_batches(session.users_collection(), documents)
+    await insert_batches(session.activities_collection(), activities)
+
+    return {
+        'users': users,
+        'friendships': sum(map(len, friends)) // 2,
+        'max_friends': max(map(len, friends), default=0),
+        'activities': len(activities),
+        'pending_requests': requests
+    }
+
+
+async def main(args: argparse.Namespace):
+    session.connect()
+    try:
+        if await session.users_collection().estimated_document_count() and not args.drop:
+            print(f'{settings.db_name} already holds users, pass --drop to replace them')
+            return
+
+        for name in COLLECTIONS:
+            await session.db().drop_collection(name)
+        await sync_indexes(session.db())
+
+        start = time.perf_counter()
+        stats = await generate(
+            args.users, args.seed, args.links, args.activities_per_user, args.days, args.requests_per_user
+        )
+        print(f"Created {stats['users']} users ({stats['friendships']} friendships, at most {stats['max_friends']} "
+              f"friends), {stats['activities']} activities and {stats['pending_requests']} pending requests "
+              f"in {settings.db_name} in {time.perf_counter() - start:.1f}s")
+
+        if settings.feed_timelines_enabled:
+            print(f'Rebuilt {await timeline_model.rebuild_all_timelines()} timelines')
+        if args.recommendations:
+            recommendations = await run_recommendation_job()
+            print(f"Ranked recommendations of {recommendations['users']} users")
+    finally:
+        await session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--links', type=int, default=8, help='friendships each new user starts with')
+    parser.add_argument('--activities-per-user', type=float, default=20)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--requests-per-user', type=int, default=2)
+    parser.add_argument('--recommendations', action='store_true', help='run the recommendation job afterwards')
+    parser.add_argument('--drop', action='store_true', help='replace the data already in the database')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,106 @@
+# Cost of the Prometheus instrumentation (utils/metrics.py), needs prometheus_client:
+# - per request: MetricsMiddleware around an ASGI app that does nothing, against the bare app, next to the latency
+#   of a small FastAPI endpoint driven in-process (comparing two full apps drowns the difference in noise)
+# - per Mongo command: started() + succeeded() of the command listener with a find reply, without a database
+#
+#   python -m benchmark.metrics_overhead --requests 20000 --commands 200000
+import argparse
+import asyncio
+import statistics
+import time
+from types import SimpleNamespace
+
+import httpx
+from fastapi import FastAPI
+
+from utils.metrics import MetricsMiddleware, MongoCommandMetrics, metrics_enabled
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/items/{item_id}')
+    async def get_item(item_id: int):
+        return {'id': item_id, 'name': f'item {item_id}'}
+
+    return app
+
+
+async def time_requests(app: FastAPI, requests: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        start = time.perf_counter()
+        for i in range(requests):
+            (await client.get(f'/items/{i % 100}')).raise_for_status()
+        return (time.perf_counter() - start) / requests
+
+
+async def empty_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def time_calls(app, requests: int) -> float:
+    scope = {'type': 'http', 'method': 'GET', 'path': '/items/1', 'route': SimpleNamespace(path='/items/{item_id}')}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(_message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(scope, receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+async def measure_requests(requests: int, rounds: int) -> dict[str, float]:
+    endpoint_us = await time_requests(build_app(), requests // rounds) * 1e6
+
+    instrumented = MetricsMiddleware(empty_app)
+    plain_times, instrumented_times = [], []
+    for _ in range(rounds):
+        plain_times.append(await time_calls(empty_app, requests))
+        instrumented_times.append(await time_calls(instrumented, requests))
+
+    overhead_us = (statistics.median(instrumented_times) - statistics.median(plain_times)) * 1e6
+    return {
+        'endpoint_us': endpoint_us,
+        'overhead_us': overhead_us,
+        'overhead_percent': overhead_us / endpoint_us * 100,
+    }
+
+
+def measure_commands(commands: int) -> float:
+    listener = MongoCommandMetrics()
+    address = ('localhost', 27017)
+    started = [SimpleNamespace(
+        connection_id=address, request_id=i, command_name='find', command={'find': 'users', 'filter': {}}
+    ) for i in range(1000)]
+    succeeded = [SimpleNamespace(
+        connection_id=address, request_id=i, command_name='find', duration_micros=500,
+        reply={'cursor': {'firstBatch': [{}] * 20, 'id': 0}}
+    ) for i in range(1000)]
+
+    start = time.perf_counter()
+    for i in range(commands):
+        listener.started(started[i % 1000])
+        listener.succeeded(succeeded[i % 1000])
+    return (time.perf_counter() - start) / commands * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--commands', type=int, default=200000)
+    args = parser.parse_args()
+
+    if not metrics_enabled():
+        raise SystemExit('Needs prometheus_client and METRICS_ENABLED=true')
+
+    result = asyncio.run(measure_requests(args.requests, args.rounds))
+    print(f"request: {result['overhead_us']:.2f} us in the middleware, {result['overhead_percent']:.1f}% of "
+          f"{result['endpoint_us']:.0f} us for the smallest endpoint")
+    print(f'command: {measure_commands(args.commands):.2f} us per command in the listener')
@@ -0,0 +1,55 @@
+# CPU cost of renewing an access token: re-posting the password to /token (bcrypt verify + HS256 signature)
+# against /token/refresh (sha256 of the presented token + a new random token + HS256 signature).
+# The Mongo round trips are the same single point lookup/write for both paths and are left out, so the numbers
+# are the CPU an API node spends per renewal.
+#
+#   python -m benchmark.refresh_token_load --renewals 200
+import argparse
+import secrets
+import time
+from datetime import timedelta
+
+import controller.auth_controller as auth_controller
+import utils.password_hasher as password_hasher
+
+
+def password_renewal(password: str, password_hash: str):
+    assert password_hasher.verify_password(password, password_hash)
+    auth_controller.create_access_token({'sub': 'user', 'username': 'user'}, timedelta(minutes=30))
+
+
+def refresh_renewal(refresh_token: str):
+    auth_controller.hash_refresh_token(refresh_token)
+    auth_controller.hash_refresh_token(secrets.token_urlsafe(32))
+    auth_controller.create_access_token({'sub': 'user', 'username': 'user'}, timedelta(minutes=30))
+
+
+def cpu_seconds(fn, renewals: int, *args) -> float:
+    start = time.process_time()
+    for _ in range(renewals):
+        fn(*args)
+    return time.process_time() - start
+
+
+def main(renewals: int, active_users: int):
+    password_hash = password_hasher.hash_password('benchmark-password')
+    refresh_token = secrets.token_urlsafe(32)
+
+    password_cpu = cpu_seconds(password_renewal, renewals, 'benchmark-password', password_hash) / renewals
+    refresh_cpu = cpu_seconds(refresh_renewal, renewals * 100, refresh_token) / (renewals * 100)
+
+    # every active user renews twice an hour
+    renewals_per_second = active_users * 2 / 3600
+    print(f'password renewal: {password_cpu * 1000:9.3f} ms CPU')
+    print(f'refresh renewal:  {refresh_cpu * 1000:9.3f} ms CPU  ({password_cpu / refresh_cpu:.0f}x less)')
+    print(f'{active_users} active users -> {renewals_per_second:.1f} renewals/s: '
+          f'{password_cpu * renewals_per_second:.2f} cores with passwords, '
+          f'{refresh_cpu * renewals_per_second:.4f} cores with refresh tokens')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renewals', type=int, default=200)
+    parser.add_argument('--active-users', type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.renewals, args.active_users)
@@ -0,0 +1,206 @@
+# Scenario benchmarks driving the whole app in-process (middleware, routing, validation, serialization and the
+# database) through httpx.ASGITransport, against the dataset created by benchmark/dataset.py. The lifespan runs
+# like under uvicorn, so the pools and the index sync behave the same. Every scenario sends --requests requests
+# from --concurrency concurrent clients as random users of the dataset.
+#
+# Background tasks (image variants of create-activity) run before ASGITransport returns the response, so they
+# count in that scenario's latency. The images are tiny, so that is little more than opening them.
+#
+#   python -m benchmark.scenarios --concurrency 50 --requests 2000 --output results.json
+#   python -m benchmark.scenarios --scenario feed --scenario search
+import os
+
+os.environ.setdefault('DB_NAME', 'eco_social_benchmark')
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import struct
+import subprocess
+import time
+import zlib
+from datetime import datetime, timezone, timedelta
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+from config.settings import settings
+from controller.auth_controller import create_access_token
+from db.session import session
+from benchmark.dataset import PASSWORD
+from benchmark.stats import percentile
+import main as app_module
+
+
+class BenchmarkUser:
+    def __init__(self, user_id: str, username: str):
+        self.user_id = user_id
+        self.username = username
+        token = create_access_token(payload={'sub': user_id, 'username': username}, expires_delta=timedelta(hours=2))
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+
+# A PNG of random pixels, so every upload is new content and really stored
+def random_png(rng: random.Random, size: int = 64) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + rng.randbytes(size * 3) for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+Scenario = Callable[[httpx.AsyncClient, random.Random, BenchmarkUser], Awaitable[httpx.Response]]
+
+
+async def feed(client: httpx.AsyncClient, _rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.get('/activity/feed', headers=user.headers)
+
+
+async def feed_hydrate(client: httpx.AsyncClient, _rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.get('/activity/feed', params={'hydrate': 'true', 'image_width': 480}, headers=user.headers)
+
+
+async def search(client: httpx.AsyncClient, rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.get(f'/user/find/{user.username[:rng.randint(2, 4)]}')
+
+
+async def search_substring(client: httpx.AsyncClient, rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    start = rng.randrange(max(1, len(user.username) - 3))
+    return await client.get(f'/user/find/{user.username[start:start + 3]}', params={'substring': 'true'})
+
+
+async def profile(client: httpx.AsyncClient, _rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.get('/user/my-profile', headers=user.headers)
+
+
+async def recommendations(client: httpx.AsyncClient, _rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.get('/user/friend-recommendations/10', headers=user.headers)
+
+
+async def create_activity(client: httpx.AsyncClient, rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    files = [('images', (f'image{i}.png', random_png(rng), 'image/png')) for i in range(rng.randint(1, 3))]
+    data = {'activity_type': '12', 'title': 'Bike instead of car', 'caption': 'Benchmark'}
+    return await client.post('/activity/', data=data, files=files, headers=user.headers)
+
+
+async def login(client: httpx.AsyncClient, _rng: random.Random, user: BenchmarkUser) -> httpx.Response:
+    return await client.post('/token', data={'username': user.username, 'password': PASSWORD})
+
+
+SCENARIOS: dict[str, Scenario] = {
+    'feed': feed,
+    'feed-hydrate': feed_hydrate,
+    'search': search,
+    'search-substring': search_substring,
+    'profile': profile,
+    'recommendations': recommendations,
+    'create-activity': create_activity,
+    'login': login,
+}
+
+
+async def load_users(amount: int, seed: int) -> list[BenchmarkUser]:
+    users = await session.users_collection().find({}, {'username': 1}).sort('_id', 1).to_list()
+    if not users:
+        raise SystemExit(f'{settings.db_name} has no users, create them with python -m benchmark.dataset')
+    sample = random.Random(seed).sample(users, min(amount, len(users)))
+    return [BenchmarkUser(str(user['_id']), user['username']) for user in sample]
+
+
+async def run_scenario(
+        client: httpx.AsyncClient, scenario: Scenario, users: list[BenchmarkUser], requests: int, concurrency: int,
+        seed: int
+) -> dict[str, Any]:
+    rng = random.Random(seed)
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    queue = iter(range(requests))
+
+    async def worker():
+        for _ in queue:
+            user = rng.choice(users)
+            start = time.perf_counter()
+            response = await scenario(client, rng, user)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'seconds': elapsed,
+        'throughput_rps': requests / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args: argparse.Namespace):
+    names = args.scenario or list(SCENARIOS)
+    results: dict[str, Any] = {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'db_name': settings.db_name,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'feed_timelines_enabled': settings.feed_timelines_enabled,
+        },
+        'scenarios': {}
+    }
+
+    async with app_module.lifespan(app_module.app):
+        users = await load_users(args.users, args.seed)
+        results['meta']['users'] = len(users)
+
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+            for name in names:
+                if args.warmup:
+                    await run_scenario(client, SCENARIOS[name], users, args.warmup, args.concurrency, args.seed + 1)
+                result = await run_scenario(
+                    client, SCENARIOS[name], users, args.requests, args.concurrency, args.seed
+                )
+                results['scenarios'][name] = result
+                print(f"{name:>17}: {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+                      f"p95 {result['p95_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  errors {result['errors']}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='repeat to run several')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=100, help='requests sent before measuring each scenario')
+    parser.add_argument('--users', type=int, default=1000, help='users of the dataset the requests are sent as')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON, compare them with benchmark.compare')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,93 @@
+# Query plans of the user search on the dataset created by benchmark/dataset.py: every search of a sample of
+# usernames (prefixes and substrings of a few lengths, first page and the page after a cursor) is explained with
+# the filter, sort and hint of user_model.search_users. Prints the keys and documents examined per page against the
+# number of users and exits with 1 if a plan scans the collection (COLLSCAN) or sorts in memory (SORT).
+#
+#   python -m benchmark.search_plan --searches 200
+import os
+
+os.environ.setdefault('DB_NAME', 'eco_social_benchmark')
+
+import argparse
+import asyncio
+import random
+import statistics
+
+from config.settings import settings
+from db.session import session
+from db.indexes import sync_indexes
+from db.slow_queries import plan_stages
+import model.user_model as user_model
+from model.pagination_model import encode_key_cursor
+
+
+FLAGGED_STAGES = ('COLLSCAN', 'SORT')
+
+PAGE_SIZE = 20
+
+
+async def explain(search: str, cursor: str | None, substring: bool) -> dict:
+    query, index = user_model.search_query(user_model.normalize_username(search), cursor, substring)
+    return await session.db().command('explain', {
+        'find': 'users',
+        'filter': query,
+        'sort': dict(user_model.SEARCH_SORT),
+        'hint': index,
+        'limit': PAGE_SIZE + 1,
+    }, verbosity='executionStats')
+
+
+def searches(usernames: list[str], rng: random.Random, substring: bool) -> list[str]:
+    result = []
+    for username in usernames:
+        length = rng.randint(3, 5)
+        start = rng.randrange(max(1, len(username) - length + 1)) if substring else 0
+        result.append(username[start:start + length])
+    return result
+
+
+async def main(amount: int, seed: int):
+    session.connect()
+    try:
+        await sync_indexes(session.db())
+        users = await session.users_collection().find({}, {'username_lower': 1}).sort('_id', 1).to_list()
+        if not users:
+            raise SystemExit(f'{settings.db_name} has no users, create them with python -m benchmark.dataset')
+        rng = random.Random(seed)
+        sample = rng.sample(users, min(amount, len(users)))
+
+        flagged = 0
+        for substring in (False, True):
+            keys, documents = [], []
+            stages = set()
+            for search, user in zip(searches([user['username_lower'] for user in sample], rng, substring), sample):
+                # the second page starts after the user the search was taken from
+                for cursor in (None, encode_key_cursor(user['username_lower'], user['_id'])):
+                    plan = await explain(search, cursor, substring)
+                    stats = plan['executionStats']
+                    keys.append(stats['totalKeysExamined'])
+                    documents.append(stats['totalDocsExamined'])
+                    plan_stage_names = set(plan_stages(plan['queryPlanner']['winningPlan']))
+                    stages |= plan_stage_names
+                    if plan_stage_names & set(FLAGGED_STAGES):
+                        flagged += 1
+                        print(f'{search!r} (cursor: {cursor is not None}): {sorted(plan_stage_names)}')
+
+            name = 'substring' if substring else 'prefix'
+            print(f'{name:>9}: {len(keys)} pages of {len(users)} users, keys examined median '
+                  f'{statistics.median(keys):.0f} max {max(keys)}, documents examined median '
+                  f'{statistics.median(documents):.0f} max {max(documents)}, stages {sorted(stages)}')
+
+        if flagged:
+            print(f'{flagged} plans scan the collection or sort in memory')
+            raise SystemExit(1)
+    finally:
+        await session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--searches', type=int, default=200, help='usernames to take the searches from')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args.searches, args.seed))
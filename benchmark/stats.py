@@ -0,0 +1,6 @@
+import math
+
+
+# Nearest-rank percentile of already sorted samples, q between 0 and 1
+def percentile(samples: list[float], q: float) -> float:
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
@@ -0,0 +1,97 @@
+# CPU spent on building and serializing GET /user/my-profile for a user with thousands of friends: the validated
+# path (UserModel(**document) returned to FastAPI, which validates it against the response model and serializes it)
+# against the trusted path (from_document + FastJSONResponse). Both apps answer from the same in-memory document,
+# so only the model and serialization work is measured, the database isn't involved.
+#
+#   python -m benchmark.trusted_read --friends 5000 --requests 500
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timezone
+
+import httpx
+from bson import ObjectId
+from fastapi import FastAPI
+
+from model.user_model import UserModel
+from model.trusted_model import from_document
+from utils.json_response import FastJSONResponse
+from benchmark.stats import percentile
+
+
+def make_user(friends: int) -> dict:
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return {
+        '_id': ObjectId(),
+        'username': 'benchmark',
+        'password': 'hash',
+        'username_lower': 'benchmark',
+        'streak': 12,
+        'points': 3400,
+        'profile_pic': '',
+        'about_me': '',
+        'activity_count': 250,
+        'friend_count': friends,
+        'friends': [ObjectId() for _ in range(friends)],
+        'incoming_requests': [{'user_id': ObjectId(), 'username': f'user{i}', 'sent_at': now} for i in range(50)],
+        'outgoing_requests': [{'user_id': ObjectId(), 'username': f'user{i}', 'sent_at': now} for i in range(50)],
+        'last_time_on_streak': now,
+    }
+
+
+def build_app(user: dict) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/validated')
+    async def validated() -> UserModel:
+        return UserModel(**user)
+
+    @app.get('/trusted', response_model=UserModel)
+    async def trusted() -> FastJSONResponse:
+        return FastJSONResponse(from_document(UserModel, user))
+
+    return app
+
+
+async def measure(client: httpx.AsyncClient, path: str, requests: int) -> dict[str, float]:
+    await client.get(path)  # warm up
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.get(path)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+    latencies.sort()
+    return {
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bytes': len(response.content),
+    }
+
+
+async def main(friends: int, requests: int):
+    user = make_user(friends)
+    transport = httpx.ASGITransport(app=build_app(user))
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        validated = (await client.get('/validated')).json()
+        trusted = (await client.get('/trusted')).json()
+        assert validated == trusted, 'the trusted path has to return the same profile'
+
+        print(f"{friends} friends, {requests} requests")
+        results = {}
+        for name in ('validated', 'trusted'):
+            results[name] = result = await measure(client, f'/{name}', requests)
+            print(f"{name:>9}: mean {result['mean_ms']:.2f} ms  p50 {result['p50_ms']:.2f} ms  "
+                  f"p99 {result['p99_ms']:.2f} ms  ({result['bytes']} bytes)")
+        print(f"speedup {results['validated']['mean_ms'] / results['trusted']['mean_ms']:.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--friends', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.friends, args.requests))
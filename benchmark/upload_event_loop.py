@@ -0,0 +1,102 @@
+# Event loop responsiveness while concurrent 10 MB image uploads are written to disk: the previous blocking
+# open/write inside the coroutine against the copy threads of file_handler.stage_uploaded_file (the part of
+# store_uploaded_files that touches the disk, without the reference counting in Mongo). A ticker task that wants
+# to wake up every millisecond measures how late the loop lets it run, over all rounds of each path.
+#
+#   python -m benchmark.upload_event_loop --uploads 20 --size-mb 10 --rounds 5
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from uuid import uuid4
+
+from starlette.datastructures import UploadFile, Headers
+
+from config.settings import settings
+import utils.file_handler as file_handler
+from benchmark.stats import percentile
+
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+BLOCKING_CHUNK_SIZE = 1024 * 1024  # what the blocking version read at a time
+
+
+def make_upload(size: int) -> UploadFile:
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    spooled.write(PNG_HEADER + os.urandom(size - len(PNG_HEADER)))
+    spooled.seek(0)
+    return UploadFile(spooled, size=size, filename='image.png', headers=Headers({'content-type': 'image/png'}))
+
+
+async def blocking_store(uploaded_file: UploadFile) -> str:
+    filename = f'{uuid4()}.png'
+    with open(os.path.join(settings.upload_dir, filename), 'wb') as output_file:
+        while chunk := await uploaded_file.read(BLOCKING_CHUNK_SIZE):
+            output_file.write(chunk)
+    return filename
+
+
+async def blocking_store_all(uploaded_files: list[UploadFile]) -> list[str]:
+    return [await blocking_store(uploaded_file) for uploaded_file in uploaded_files]
+
+
+async def streamed_store_all(uploaded_files: list[UploadFile]) -> list[str]:
+    staged = await asyncio.gather(*map(file_handler.stage_uploaded_file, uploaded_files))
+    return [os.path.basename(temp_path) for temp_path, _filename in staged]
+
+
+async def measure(store, uploads: int, size: int) -> tuple[float, list[float]]:
+    files = [make_upload(size) for _ in range(uploads)]
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    filenames = await store(files)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+
+    for filename in filenames:
+        os.remove(os.path.join(settings.upload_dir, filename))
+
+    return elapsed, lags
+
+
+async def main(uploads: int, size_mb: int, rounds: int):
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    size = size_mb * 1024 * 1024
+    settings.max_image_size_mb = max(settings.max_image_size_mb, size_mb + 1)
+
+    # the rounds alternate between both paths so a noisy moment of the machine doesn't hit only one of them
+    stores = {'blocking': blocking_store_all, 'streamed': streamed_store_all}
+    results = {name: ([], []) for name in stores}
+    for _ in range(rounds):
+        for name, store in stores.items():
+            elapsed, lags = await measure(store, uploads, size)
+            results[name][0].append(elapsed)
+            results[name][1].extend(lags)
+
+    for name, (seconds, lags) in results.items():
+        lags.sort()
+        print(f"{name:>8}: {uploads} x {size_mb} MB in {statistics.median(seconds):.2f}s (median of {rounds})  "
+              f"loop lag p50 {statistics.median(lags) * 1000:.2f} ms  "
+              f"p99 {percentile(lags, 0.99) * 1000:.2f} ms  max {lags[-1] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=20)
+    parser.add_argument('--size-mb', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.uploads, args.size_mb, args.rounds))
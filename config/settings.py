@@ -1,3 +1,6 @@
+from functools import cache
+from typing import Any, Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -8,7 +11,71 @@ class Settings(BaseSettings):
     max_images_per_activity: int
     max_image_size_mb: int
 
-    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8')
+    db_name: str = 'eco_social'
+    # unset options keep the value given in DB_URI, or the driver default
+    db_max_pool_size: int | None = None
+    db_min_pool_size: int | None = None
+    db_max_idle_time_ms: int | None = None
+    db_connect_timeout_ms: int | None = None
+    db_server_selection_timeout_ms: int | None = None
+    db_socket_timeout_ms: int | None = None
+    db_wait_queue_timeout_ms: int | None = None
+    db_timeout_ms: int | None = None
+    db_compressors: list[Literal['zstd', 'snappy', 'zlib']] = []
+    db_read_preference: Literal[
+        'primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest'
+    ] | None = None
+
+    sync_indexes_on_startup: bool = True
+
+    upload_copy_workers: int | None = None  # see utils/file_handler.copy_workers
+
+    hash_pool_workers: int = 2
+    hash_pool_max_pending: int = 64
+
+    friend_cache_ttl_seconds: float = 30
+    friend_cache_max_ids: int = 1_000_000
+
+    storage_backend: Literal['local', 's3'] = 'local'
+    s3_bucket: str = ''
+    s3_prefix: str = ''
+    s3_endpoint_url: str | None = None
+    s3_region: str | None = None
+    s3_url_expire_seconds: int = 3600
+
+    image_variant_widths: list[int] = [160, 480, 1080]
+    image_variants_webp: bool = False
+    image_pool_workers: int = 1
+    image_pool_max_pending: int = 256
+
+    feed_timelines_enabled: bool = False
+    timeline_max_length: int = 800
+    timeline_backfill_count: int = 50
+
+    recommendations_max_age_hours: float = 24
+
+    metrics_enabled: bool = True
+
+    slow_query_enabled: bool = False
+    slow_query_threshold_ms: float = 100
+    slow_query_explain_rate: float = 0.1
+    slow_query_buffer_size: int = 200
+
+    admin_usernames: list[str] = []
+
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', env_ignore_empty=True)
+
+
+@cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+# Reads the environment on first use instead of on import, so modules can be imported without a configured
+# environment (tests, tooling) and nothing touches it until the app or a command actually starts.
+class LazySettings:
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_settings(), name)
 
 
-settings: Settings = Settings()
+settings: Settings = LazySettings()  # type: ignore[assignment]
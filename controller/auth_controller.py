@@ -1,13 +1,19 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 import jwt
 from jwt.exceptions import InvalidTokenError
 from pydantic import BaseModel
 from typing import Annotated, Dict, Any
 from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError
+from uuid import uuid4
+import hashlib
+import secrets
 
-from model.user_model import get_user_password_by_username, get_user_id_by_username, create_user
+from model.user_model import get_user_credentials_by_username, get_user_id_by_username, create_user
+import model.refresh_token_model as refresh_token_model
+from utils.password_hasher import hash_pool, HashQueueFull
+import utils.password_hasher as password_hasher
 
 from config.settings import settings
 
@@ -15,6 +21,7 @@ from config.settings import settings
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
 
 
 class TokenData(BaseModel):
@@ -24,27 +31,39 @@ class TokenData(BaseModel):
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = 30
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def run_hash(fn, *args):
+    try:
+        return await hash_pool.run(fn, *args)
+    except HashQueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Too many login attempts in progress, try again shortly',
+            headers={'Retry-After': '1'},
+        )
+
 
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_hash(password_hasher.verify_password, plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
 
+async def get_password_hash(password: str) -> str:
+    return await run_hash(password_hasher.hash_password, password)
 
-def authenticate_user(username: str, password: str):
-    password_hash = get_user_password_by_username(username)
-    if not password_hash:
-        return False
-    if not verify_password(password, password_hash):
-        return False
-    return True
+
+async def authenticate_user(username: str, password: str) -> str | None:
+    credentials = await get_user_credentials_by_username(username)
+    if not credentials:
+        return None
+    user_id, password_hash = credentials
+    if not await verify_password(password, password_hash):
+        return None
+    return user_id
 
 
 def create_access_token(payload: Dict[str, Any], expires_delta: timedelta | None) -> str:
@@ -59,7 +78,28 @@ def create_access_token(payload: Dict[str, Any], expires_delta: timedelta | None
     return encoded_jwt
 
 
-def parse_token(token: Annotated[str, Depends(oauth2_scheme)]) -> TokenData:
+def hash_refresh_token(refresh_token: str) -> str:
+    # refresh tokens are 256 random bits, a fast digest is enough (unlike passwords they can't be guessed)
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+async def issue_tokens(user_id: str, username: str, family_id: str | None = None) -> Token:
+    access_token = create_access_token(
+        payload={'sub': user_id, 'username': username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+
+    refresh_token = secrets.token_urlsafe(32)
+    await refresh_token_model.store_refresh_token(
+        token_hash=hash_refresh_token(refresh_token),
+        user_id=user_id,
+        username=username,
+        family_id=family_id or str(uuid4()),
+        expires_at=datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return Token(access_token=access_token, token_type="bearer", refresh_token=refresh_token)
+
+
+async def parse_token(token: Annotated[str, Depends(oauth2_scheme)]) -> TokenData:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -74,35 +114,49 @@ def parse_token(token: Annotated[str, Depends(oauth2_scheme)]) -> TokenData:
     return token_data
 
 
-def create_token(form_data: OAuth2PasswordRequestForm) -> Token:
-    authenticated: bool = authenticate_user(form_data.username, form_data.password)
-    if not authenticated:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+# The operators listed in ADMIN_USERNAMES
+async def parse_admin_token(token_data: Annotated[TokenData, Depends(parse_token)]) -> TokenData:
+    if token_data.username not in settings.admin_usernames:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    return token_data
 
-    user_id: str | None = get_user_id_by_username(form_data.username)
 
+async def create_token(form_data: OAuth2PasswordRequestForm) -> Token:
+    user_id: str | None = await authenticate_user(form_data.username, form_data.password)
     if not user_id:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found. This can only happen if the user was deleted while they were logged in.",
+            detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return await issue_tokens(user_id, form_data.username)
 
-    access_token = create_access_token(
-        payload={'sub': user_id, 'username': form_data.username}, expires_delta=access_token_expires
+
+async def refresh_tokens(refresh_token: str) -> Token:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid or expired refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
     )
-    return Token(access_token=access_token, token_type="bearer")
 
+    token_hash = hash_refresh_token(refresh_token)
+    stored = await refresh_token_model.rotate_refresh_token(token_hash)
+    if stored is None:
+        reused = await refresh_token_model.get_refresh_token(token_hash)
+        if reused is not None and reused['rotated_at'] is not None:  # somebody is replaying an old token
+            await refresh_token_model.revoke_family(reused['family_id'])
+        raise credentials_exception
+
+    return await issue_tokens(stored['user_id'], stored['username'], stored['family_id'])
 
-def create_account(form_data: OAuth2PasswordRequestForm) -> bool:
-    if get_user_id_by_username(form_data.username):
+
+async def create_account(form_data: OAuth2PasswordRequestForm) -> bool:
+    if await get_user_id_by_username(form_data.username):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Username taken')
+    password_hash = await get_password_hash(form_data.password)
+    try:
+        return await create_user(username=form_data.username, password_hash=password_hash)
+    except DuplicateKeyError:  # someone took the username while we were hashing
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Username taken')
-    password_hash = get_password_hash(form_data.password)
-    return create_user(username=form_data.username, password_hash=password_hash)
 
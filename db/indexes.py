@@ -0,0 +1,74 @@
+# Every index the model modules rely on, next to the queries that need it.
+# sync_indexes() creates them idempotently (at startup and through `python manage.py indexes --sync`),
+# index_report() compares them with what exists on the server.
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from pymongo.asynchronous.database import AsyncDatabase
+from typing import Any
+
+
+INDEXES: dict[str, list[IndexModel]] = {
+    'users': [
+        # get_user_id_by_username, get_user_credentials_by_username (login) and the username taken check on signup
+        IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+        # search_users: anchored prefix search, sorted and paginated by (username_lower, _id)
+        IndexModel([('username_lower', ASCENDING), ('_id', ASCENDING)], name='username_lower_id'),
+        # search_users(substring=True): equality on one trigram, then already in the (username_lower, _id) order
+        IndexModel([('username_trigrams', ASCENDING), ('username_lower', ASCENDING), ('_id', ASCENDING)],
+                   name='username_trigrams_lower_id'),
+    ],
+    'activities': [
+        # get_user_activities (user_id equality) and get_feed (user_id $in), both sorted by the keyset cursor
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='user_id_created_at_id'),
+    ],
+    'refresh_tokens': [
+        # expired refresh tokens are removed by the TTL monitor
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+        # refresh_token_model.revoke_family
+        IndexModel([('family_id', ASCENDING)], name='family_id'),
+    ],
+    'images': [
+        # image_model.get_updated_since, the garbage collector's check for images referenced while it ran
+        IndexModel([('updated_at', ASCENDING)], name='updated_at'),
+    ],
+    'timelines': [
+        # timeline_model.remove_activity
+        IndexModel([('items.activity_id', ASCENDING)], name='items_activity_id'),
+    ],
+}
+
+
+async def sync_indexes(db: AsyncDatabase) -> list[str]:
+    errors = []
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except OperationFailure as e:  # e.g. duplicate usernames or an index with the same name but other options
+            errors.append(f'{collection_name}: {e}')
+    return errors
+
+
+async def index_report(db: AsyncDatabase) -> list[dict[str, Any]]:
+    report = []
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        declared = {index.document['name'] for index in indexes}
+        existing = set(await collection.index_information())
+
+        usage = {}
+        async for stats in await collection.aggregate([{'$indexStats': {}}]):
+            usage[stats['name']] = stats['accesses']['ops']
+
+        for name in sorted(declared | existing - {'_id_'}):
+            if name not in existing:
+                status = 'missing'
+            elif name not in declared:
+                status = 'undeclared'
+            elif usage.get(name, 0) == 0:
+                status = 'unused'
+            else:
+                status = 'ok'
+            report.append({'collection': collection_name, 'index': name, 'status': status, 'ops': usage.get(name, 0)})
+
+    return report
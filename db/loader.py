@@ -0,0 +1,163 @@
+# Request-scoped identity map for documents looked up by _id.
+# LoaderMiddleware gives every HTTP request its own set of loaders. Loads issued in the same event loop iteration
+# are batched into one $in query, and every document is memoized for the rest of the request, so the model
+# functions can look up the same user several times per request and only the first lookup reaches Mongo.
+# Loads name the fields they need, the loader only goes back to Mongo for fields it hasn't read yet.
+# Outside of a request (jobs, manage.py) find_by_id falls back to a plain find_one.
+import asyncio
+from contextvars import ContextVar
+from typing import Any, Iterable
+
+from bson import ObjectId
+from pymongo.asynchronous.collection import AsyncCollection
+
+from db.session import session
+
+
+class DocumentLoader:
+    def __init__(self, collection: AsyncCollection):
+        self._collection = collection
+        # _id -> (fields read so far, None meaning the whole document; the document or None if it doesn't exist)
+        self._cache: dict[ObjectId, tuple[frozenset[str] | None, dict[str, Any] | None]] = {}
+        self._pending: dict[ObjectId, asyncio.Future] = {}
+        self._pending_fields: set[str] | None = set()
+        self._in_flight: set[ObjectId] = set()
+        self._forgotten_in_flight: set[ObjectId] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self.queries = 0
+
+    async def load(self, _id: ObjectId, fields: Iterable[str] | None = None) -> dict[str, Any] | None:
+        fields = frozenset(fields) if fields is not None else None
+
+        cached = self._cache.get(_id)
+        if cached is not None:
+            cached_fields, document = cached
+            if document is None or cached_fields is None or (fields is not None and fields <= cached_fields):
+                return document
+
+        # one query per event loop iteration, reading the union of the fields everybody asked for
+        if fields is None:
+            self._pending_fields = None
+        elif self._pending_fields is not None:
+            self._pending_fields |= fields
+
+        future = self._pending.get(_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            future = loop.create_future()
+            self._pending[_id] = future
+
+        return await asyncio.shield(future)
+
+    async def load_many(
+            self, ids: list[ObjectId], fields: Iterable[str] | None = None
+    ) -> list[dict[str, Any] | None]:
+        fields = list(fields) if fields is not None else None
+        return list(await asyncio.gather(*(self.load(_id, fields) for _id in ids)))
+
+    def forget(self, *ids: ObjectId):
+        for _id in ids:
+            self._cache.pop(_id, None)
+            if _id in self._in_flight:
+                self._forgotten_in_flight.add(_id)
+
+    def _dispatch(self):
+        batch, self._pending = self._pending, {}
+        fields, self._pending_fields = self._pending_fields, set()
+        task = asyncio.create_task(self._fetch(batch, frozenset(fields) if fields is not None else None))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, batch: dict[ObjectId, asyncio.Future], fields: frozenset[str] | None):
+        self._in_flight.update(batch)
+        self.queries += 1
+        try:
+            results = await self._collection.find({'_id': {'$in': list(batch)}}, to_projection(fields)).to_list()
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight.difference_update(batch)
+
+        by_id = {result['_id']: result for result in results}
+        for _id, future in batch.items():
+            document = by_id.get(_id)
+            if _id in self._forgotten_in_flight:  # modified while we were reading it
+                self._forgotten_in_flight.discard(_id)
+            else:
+                document = self._merge(_id, fields, document)
+            if not future.done():
+                future.set_result(document)
+
+    def _merge(self, _id: ObjectId, fields: frozenset[str] | None, document: dict[str, Any] | None):
+        cached = self._cache.get(_id)
+        if document is not None and fields is not None and cached is not None and cached[1] is not None:
+            cached_fields, cached_document = cached
+            fields = fields | cached_fields if cached_fields is not None else None
+            document = {**cached_document, **document}
+
+        self._cache[_id] = (fields, document)
+        return document
+
+
+def to_projection(fields: Iterable[str] | None) -> dict[str, int] | None:
+    return {field: 1 for field in fields} if fields is not None else None
+
+
+_loaders: ContextVar[dict[str, DocumentLoader] | None] = ContextVar('loaders', default=None)
+
+
+def get_loader(collection_name: str) -> DocumentLoader | None:
+    loaders = _loaders.get()
+    if loaders is None:
+        return None
+
+    loader = loaders.get(collection_name)
+    if loader is None:
+        loader = loaders[collection_name] = DocumentLoader(session.db()[collection_name])
+    return loader
+
+
+# fields=None reads whole documents. The returned documents always have the requested fields (when they are set)
+# but inside of a request they may have more, read earlier by somebody else.
+async def find_by_id(
+        collection_name: str, _id: ObjectId, fields: Iterable[str] | None = None
+) -> dict[str, Any] | None:
+    loader = get_loader(collection_name)
+    if loader is None:
+        return await session.db()[collection_name].find_one({'_id': _id}, to_projection(fields))
+    return await loader.load(_id, fields)
+
+
+async def find_by_ids(
+        collection_name: str, ids: list[ObjectId], fields: Iterable[str] | None = None
+) -> list[dict[str, Any]]:
+    loader = get_loader(collection_name)
+    if loader is None:
+        return await session.db()[collection_name].find({'_id': {'$in': ids}}, to_projection(fields)).to_list()
+    return [document for document in await loader.load_many(ids, fields) if document is not None]
+
+
+def forget(collection_name: str, *ids: ObjectId):
+    loader = get_loader(collection_name)
+    if loader is not None:
+        loader.forget(*ids)
+
+
+class LoaderMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        token = _loaders.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _loaders.reset(token)
@@ -1,28 +1,85 @@
-from pymongo.mongo_client import MongoClient
-from pymongo.synchronous.database import Database
-from pymongo.synchronous.collection import Collection
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.asynchronous.collection import AsyncCollection
 from typing import Any
 
 from config.settings import settings
+from utils.metrics import mongo_listeners
+from db.slow_queries import slow_query_listeners
 
 
+# Options of DB_URI that can be overridden in the settings, unset ones aren't passed to the driver
+def client_options() -> dict[str, Any]:
+    options = {
+        'maxPoolSize': settings.db_max_pool_size,
+        'minPoolSize': settings.db_min_pool_size,
+        'maxIdleTimeMS': settings.db_max_idle_time_ms,
+        'connectTimeoutMS': settings.db_connect_timeout_ms,
+        'serverSelectionTimeoutMS': settings.db_server_selection_timeout_ms,
+        'socketTimeoutMS': settings.db_socket_timeout_ms,
+        'waitQueueTimeoutMS': settings.db_wait_queue_timeout_ms,
+        'timeoutMS': settings.db_timeout_ms,
+        'compressors': settings.db_compressors or None,
+        'readPreference': settings.db_read_preference,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+# The client is created by connect(), in the lifespan of the app or at the start of a command, never on import.
+# Creating it does no I/O except resolving mongodb+srv:// hosts, the connections are opened in the background.
 class Session:
-    def __init__(self, conn_string: str):
-        self._client: MongoClient[dict[str, Any]] = MongoClient(conn_string)
-        self._db = self._client.get_database('eco_social')
+    def __init__(self):
+        self._client: AsyncMongoClient[dict[str, Any]] | None = None
+        self._db: AsyncDatabase | None = None
+
+    def connect(self) -> None:
+        if self._client is not None:
+            return
+        self._client = AsyncMongoClient(
+            settings.db_uri, event_listeners=[*mongo_listeners(), *slow_query_listeners()], **client_options()
+        )
+        self._db = self._client.get_database(settings.db_name)
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None
+
+    async def ping(self) -> None:
+        await self.db().command('ping')
 
-        # Check if the connection is valid
-        self._client.server_info()
+    async def check_connection(self) -> None:
+        # Opens the connection pool (minPoolSize connections) and checks the server answers
+        await self._client.aconnect()
+        await self.ping()
         print('Connected to the MongoDB')
 
-    def db(self) -> Database:
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = self._db = None
+
+    def db(self) -> AsyncDatabase:
+        if self._db is None:
+            raise RuntimeError('The database session is not connected, call session.connect() first')
         return self._db
 
-    def users_collection(self) -> Collection:
-        return self._db.users
+    def users_collection(self) -> AsyncCollection:
+        return self.db().users
+
+    def activities_collection(self) -> AsyncCollection:
+        return self.db().activities
+
+    def timelines_collection(self) -> AsyncCollection:
+        return self.db().timelines
+
+    def recommendations_collection(self) -> AsyncCollection:
+        return self.db().recommendations
+
+    def refresh_tokens_collection(self) -> AsyncCollection:
+        return self.db().refresh_tokens
 
-    def activities_collection(self) -> Collection:
-        return self._db.activities
+    def images_collection(self) -> AsyncCollection:
+        return self.db().images
 
 
-session: Session = Session(settings.db_uri)
+session: Session = Session()
@@ -0,0 +1,191 @@
+# Opt-in recorder of slow Mongo commands (SLOW_QUERY_ENABLED=true), registered as a CommandListener on the Session
+# client. Commands slower than SLOW_QUERY_THRESHOLD_MS are kept in a bounded ring buffer (GET /admin/slow-queries)
+# and printed, together with the model function that issued them and the route of the request.
+# A sample of them (SLOW_QUERY_EXPLAIN_RATE) is explained in the background and flagged when the winning plan
+# scans the whole collection (COLLSCAN) or sorts in memory (SORT) instead of walking an index.
+#
+# Fast commands only cost a dict insert and pop. The caller is looked up on the stack only for slow commands: the
+# driver reports the reply from the coroutine that awaited it, so the model function is still on the stack.
+import asyncio
+import random
+import sys
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any
+
+from pymongo import monitoring
+
+from config.settings import settings
+
+
+EXPLAINABLE_COMMANDS = ('find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify')
+
+# The first frame of these packages is reported as the caller
+CALLER_PACKAGES = ('model.', 'job.', 'controller.', 'router.', 'db.loader')
+
+_request_scope: ContextVar[dict[str, Any] | None] = ContextVar('request_scope', default=None)
+
+
+# Makes the route of the current request available to the listener
+class RequestContextMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_scope.reset(token)
+
+
+def current_route() -> str | None:
+    scope = _request_scope.get()
+    if scope is None:
+        return None
+    route = scope.get('route')  # set once the router matched
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+def find_caller() -> str | None:
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith(CALLER_PACKAGES):
+            return f'{module}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+# Fields that hold no user data and tell which index should have been used
+PLAIN_FIELDS = ('sort', 'projection', 'hint', '$sort', '$project')
+
+
+# The command without its values, so the buffer holds the query shape and no user data
+def shape(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: item if key in PLAIN_FIELDS else shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shape(item) for item in value[:5]] + (['...'] if len(value) > 5 else [])
+    return '?'
+
+
+# The command to send to explain, without the fields the driver adds to every command
+def explainable(command: dict[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in command.items() if key not in ('lsid', 'txnNumber') and key[0] != '$'}
+
+
+def plan_stages(explain: Any) -> list[str]:
+    stages = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'stage' and isinstance(value, str):
+                stages.append(value)
+            elif key != 'rejectedPlans':
+                stages += plan_stages(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            stages += plan_stages(item)
+    return stages
+
+
+class SlowQueryRecorder(monitoring.CommandListener):
+    def __init__(self, threshold_ms: float, explain_rate: float, max_entries: int):
+        self._threshold_micros = threshold_ms * 1000
+        self._explain_rate = explain_rate
+        self._started: dict[tuple[Any, int], dict[str, Any]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.entries: deque[dict[str, Any]] = deque(maxlen=max_entries)
+        self.recorded = 0
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        self._started[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        command = self._started.pop((event.connection_id, event.request_id), None)
+        if event.duration_micros >= self._threshold_micros and command is not None:
+            self._record(event, command, None)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        command = self._started.pop((event.connection_id, event.request_id), None)
+        if event.duration_micros >= self._threshold_micros and command is not None:
+            self._record(event, command, str(event.failure.get('errmsg', '')))
+
+    def _record(self, event: monitoring.CommandSucceededEvent | monitoring.CommandFailedEvent,
+                command: dict[str, Any], error: str | None):
+        command_name = event.command_name
+        target = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+        entry = {
+            'at': datetime.now(timezone.utc).isoformat(),
+            'command': command_name,
+            'database': event.database_name,
+            'collection': target if isinstance(target, str) else None,
+            'duration_ms': event.duration_micros / 1000,
+            'caller': find_caller(),
+            'route': current_route(),
+            'shape': shape(explainable(command)),
+            'error': error,
+            'plan': None,
+        }
+        self.entries.append(entry)
+        self.recorded += 1
+        print(f"Slow query: {entry['command']} {entry['collection']} took {entry['duration_ms']:.1f} ms "
+              f"in {entry['caller']} ({entry['route']})")
+
+        if command_name in EXPLAINABLE_COMMANDS and random.random() < self._explain_rate:
+            try:
+                task = asyncio.get_running_loop().create_task(self._explain(entry, explainable(command)))
+            except RuntimeError:  # no event loop, e.g. a client used from a thread
+                return
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, entry: dict[str, Any], command: dict[str, Any]):
+        from db.session import session  # the session registers this listener, so it can't be imported above
+
+        try:
+            explain = await session.db().client.get_database(entry['database']).command(
+                {'explain': command, 'verbosity': 'queryPlanner'}
+            )
+        except Exception as e:
+            print(f"Could not explain the slow {entry['command']} on {entry['collection']}: {e!r}")
+            return
+
+        stages = plan_stages(explain)
+        entry['plan'] = {
+            'stages': stages,
+            'collscan': 'COLLSCAN' in stages,
+            'in_memory_sort': 'SORT' in stages,
+        }
+        flags = [flag for flag, stage in (('COLLSCAN', 'COLLSCAN'), ('in-memory SORT', 'SORT')) if stage in stages]
+        if flags:
+            print(f"Slow query plan of {entry['command']} {entry['collection']} in {entry['caller']}: "
+                  f"{', '.join(flags)} ({' <- '.join(stages)})")
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'threshold_ms': self._threshold_micros / 1000,
+            'explain_rate': self._explain_rate,
+            'recorded': self.recorded,
+            'buffered': len(self.entries),
+            'max_entries': self.entries.maxlen,
+        }
+
+
+# Created with the client by session.connect(), None while the recorder is disabled
+slow_query_recorder: SlowQueryRecorder | None = None
+
+
+def slow_query_listeners() -> list[monitoring.CommandListener]:
+    global slow_query_recorder
+    if not settings.slow_query_enabled:
+        return []
+    if slow_query_recorder is None:
+        slow_query_recorder = SlowQueryRecorder(
+            settings.slow_query_threshold_ms, settings.slow_query_explain_rate, settings.slow_query_buffer_size
+        )
+    return [slow_query_recorder]
@@ -0,0 +1,135 @@
+# Batch job deleting stored images nothing references anymore: files left behind by failed requests, by reference
+# counts that were never released, and by older versions that didn't count references at all.
+# The referenced filenames are streamed from activities.images and users.profile_pic into a set of compact keys,
+# then the storage is walked a directory (or listing page) at a time. Files not referenced and not modified for
+# the grace period are deleted in bounded batches, at most max_per_second files per second.
+# Variants ({stem}_{width}.{ext}) belong to the image with the same stem.
+# Uploads and variants are written to temporary files in settings.upload_dir before they are saved, whatever the
+# backend. With S3 the ones a failed request left there aren't in the walk and are swept separately.
+import asyncio
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from itertools import islice
+from typing import Any, Iterator
+
+from config.settings import settings
+import model.image_model as image_model
+from utils.storage import get_storage, LocalStorage
+
+
+# sha256 digests and uuids as raw bytes take a fraction of the memory of the str
+def image_key(filename: str) -> bytes | str:
+    stem = filename.split('.', 1)[0].split('_', 1)[0]
+    try:
+        return bytes.fromhex(stem.replace('-', ''))
+    except ValueError:
+        return stem
+
+
+async def load_referenced_keys() -> set[bytes | str]:
+    return {image_key(filename) async for filename in image_model.referenced_filenames()}
+
+
+def _take(entries: Iterator, amount: int) -> list:
+    return list(islice(entries, amount))
+
+
+# The files are hidden first, then the counts are checked for images referenced since the job started. Those
+# get their files back (an upload of the same content may have put its own copy in place already).
+async def _delete_batch(filenames: list[str], started_at: datetime) -> list[str]:
+    storage = get_storage()
+    hidden = await asyncio.to_thread(lambda: {filename: storage.hide([filename]) for filename in filenames})
+
+    recent = {image_key(filename) for filename in await image_model.get_updated_since(started_at)}
+    deleted = [filename for filename in filenames if image_key(filename) not in recent]
+
+    await asyncio.to_thread(lambda: [
+        storage.unhide(tombstones, image_key(filename) not in recent) for filename, tombstones in hidden.items()
+    ])
+    await image_model.delete_counts(deleted, started_at)
+    return deleted
+
+
+# The temporary files left in the staging directory, not modified since the cutoff. Returns how many there were.
+def remove_temp_files(directory: str, cutoff: float, dry_run: bool) -> int:
+    removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not (entry.name.startswith('.') and entry.name.endswith('.tmp')):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if max(stat.st_mtime, stat.st_ctime) >= cutoff:
+                    continue
+                if not dry_run:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                removed += 1
+    except FileNotFoundError:  # nothing was uploaded by this host yet
+        pass
+    return removed
+
+
+async def run_image_gc(
+        grace_period: timedelta = timedelta(hours=24),
+        batch_size: int = 500,
+        max_per_second: float = 200,
+        dry_run: bool = False
+) -> dict[str, Any]:
+    started_at = datetime.now(timezone.utc)
+    cutoff = (started_at - grace_period).timestamp()
+
+    referenced = await load_referenced_keys()
+    print(f'{len(referenced)} images are referenced')
+
+    stats = {'scanned': 0, 'referenced': len(referenced), 'deleted': 0, 'deleted_bytes': 0, 'leftovers': 0}
+    storage = get_storage()
+    entries = storage.walk()
+    orphans: list[tuple[str, int]] = []
+    leftovers: list[str] = []
+
+    async def flush(final: bool = False):
+        nonlocal orphans, leftovers
+        while len(orphans) >= batch_size or (final and orphans):
+            batch, orphans = orphans[:batch_size], orphans[batch_size:]
+            batch_start = time.perf_counter()
+
+            sizes = dict(batch)
+            deleted = list(sizes) if dry_run else await _delete_batch(list(sizes), started_at)
+            stats['deleted'] += len(deleted)
+            stats['deleted_bytes'] += sum(sizes[filename] for filename in deleted)
+            print(f"{'Would delete' if dry_run else 'Deleted'} {stats['deleted']} files "
+                  f"({stats['deleted_bytes'] / 1024 ** 3:.2f} GB) of {stats['scanned']} scanned")
+
+            # rate limit, the storage also serves the API
+            if not dry_run:
+                await asyncio.sleep(max(0.0, len(batch) / max_per_second - (time.perf_counter() - batch_start)))
+
+        if leftovers and (final or len(leftovers) >= batch_size):
+            if not dry_run:
+                await asyncio.to_thread(storage.remove, leftovers)
+            stats['leftovers'] += len(leftovers)
+            leftovers = []
+
+    while batch := await asyncio.to_thread(_take, entries, 1000):
+        for location, filename, modified, size in batch:
+            stats['scanned'] += 1
+            if modified >= cutoff:
+                continue
+            if filename.startswith('.'):  # temporary upload or tombstone nobody finished
+                leftovers.append(location)
+            elif image_key(filename) not in referenced:
+                orphans.append((filename, size))
+        await flush()
+    await flush(final=True)
+
+    # LocalStorage keeps its files under settings.upload_dir, the walk already went through the temporary files
+    if not isinstance(storage, LocalStorage) or os.path.abspath(storage.root) != os.path.abspath(settings.upload_dir):
+        stats['leftovers'] += await asyncio.to_thread(remove_temp_files, settings.upload_dir, cutoff, dry_run)
+
+    return stats
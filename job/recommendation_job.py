@@ -0,0 +1,94 @@
+# Batch job precomputing friend recommendations for every user.
+# The friend graph is loaded once into an adjacency list of int arrays, which is sent to every worker of a
+# process pool when it starts. Workers rank chunks of users with the same rank_recommendations the online path uses.
+import asyncio
+import os
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from db.session import session
+from model.user_model import rank_recommendations
+import model.recommendation_model as recommendation_model
+from utils.process_pool import mp_context
+
+
+_adjacency: list[array] = []
+
+
+def _init_worker(adjacency: list[array]):
+    global _adjacency
+    _adjacency = adjacency
+
+
+# The users are indexed in _id order, and ObjectId strings (fixed width hex) sort like the ObjectIds. Comparing the
+# indices breaks ties the same way as the online ranking comparing the ids as strings.
+def _by_index(user: int) -> int:
+    return user
+
+
+def _rank_chunk(start: int, stop: int, amount: int) -> list[tuple[int, list[int]]]:
+    ranked = []
+    for user in range(start, stop):
+        friends = _adjacency[user]
+        ranked.append((user, rank_recommendations(
+            user, friends, (_adjacency[friend] for friend in friends), amount, tie_break=_by_index
+        )))
+    return ranked
+
+
+async def load_friend_graph() -> tuple[list[ObjectId], list[array]]:
+    user_ids: list[ObjectId] = []
+    friend_ids: list[list[ObjectId]] = []
+    async for user in session.users_collection().find({}, {'friends': 1}).sort('_id', ASCENDING):
+        user_ids.append(user['_id'])
+        friend_ids.append(user.get('friends', []))
+
+    index = {user_id: i for i, user_id in enumerate(user_ids)}
+    # friends pointing at deleted users are dropped
+    adjacency = [array('I', sorted(index[f] for f in friends if f in index)) for friends in friend_ids]
+    return user_ids, adjacency
+
+
+async def run_recommendation_job(
+        workers: int | None = None,
+        chunk_size: int = 1000,
+        amount: int = recommendation_model.STORED_RECOMMENDATIONS
+) -> dict[str, float]:
+    workers = workers or os.cpu_count() or 1
+
+    load_start = time.perf_counter()
+    user_ids, adjacency = await load_friend_graph()
+    load_seconds = time.perf_counter() - load_start
+
+    computed_at = datetime.now(timezone.utc)
+    compute_start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(
+            workers, mp_context=mp_context(), initializer=_init_worker, initargs=(adjacency,)
+    ) as executor:
+        chunks = [
+            loop.run_in_executor(executor, _rank_chunk, start, min(start + chunk_size, len(user_ids)), amount)
+            for start in range(0, len(user_ids), chunk_size)
+        ]
+        for chunk in asyncio.as_completed(chunks):
+            ranked = await chunk
+            await recommendation_model.save_recommendations(
+                [(user_ids[user], [user_ids[r] for r in recommended]) for user, recommended in ranked], computed_at
+            )
+
+    compute_seconds = time.perf_counter() - compute_start
+    users_per_second = len(user_ids) / compute_seconds if compute_seconds else 0.0
+    return {
+        'users': len(user_ids),
+        'workers': workers,
+        'load_seconds': load_seconds,
+        'compute_seconds': compute_seconds,
+        'users_per_second': users_per_second,
+        'users_per_second_per_core': users_per_second / workers,
+    }
@@ -1,7 +1,9 @@
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from pymongo.errors import PyMongoError
+import asyncio
 import os
 
 # imports needed for the hello endpoint
@@ -10,19 +12,55 @@ from controller.auth_controller import parse_token, TokenData
 from router.auth_router import auth_router
 from router.user_router import user_router
 from router.activity_router import activity_router
+from router.metrics_router import metrics_router
+from router.static_router import static_router
+from router.admin_router import admin_router
+from router.health_router import health_router
 
 from config.settings import settings
-
-
-os.makedirs(settings.upload_dir, exist_ok=True)
-
-
-app = FastAPI()
+from db.session import session
+from db.indexes import sync_indexes
+from db.loader import LoaderMiddleware
+from db.slow_queries import RequestContextMiddleware
+from utils.metrics import MetricsMiddleware
+from utils.password_hasher import hash_pool
+from utils.image_processor import image_pool
+from utils.file_handler import shutdown_copy_executor
+
+
+# Runs in the background, so a worker serves /health as soon as it started. /ready waits for it.
+async def prepare_database():
+    try:
+        await session.check_connection()
+        if settings.sync_indexes_on_startup:
+            for error in await sync_indexes(session.db()):
+                print(f'Index sync failed for {error}')
+    except PyMongoError as e:
+        print(f'Could not prepare the database: {e!r}')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    # creating the client only resolves mongodb+srv:// hosts, which blocks, the connections open in the background
+    await asyncio.to_thread(session.connect)
+    app.state.startup = asyncio.create_task(prepare_database())
+    yield
+    app.state.startup.cancel()
+    hash_pool.shutdown()
+    image_pool.shutdown()
+    shutdown_copy_executor()
+    await session.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:40191",
 ]
 
+app.add_middleware(LoaderMiddleware)
+app.add_middleware(RequestContextMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -30,6 +68,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)  # outermost, so the latency includes the other middleware
 
 
 @app.get('/')
@@ -42,9 +81,10 @@ async def say_hello(token_data: TokenData = Depends(parse_token)):
     return {'message': f'Hello {token_data.username}'}
 
 
-app.mount('/static', StaticFiles(directory=settings.upload_dir), name='static')
-
-
+app.include_router(health_router)
 app.include_router(auth_router)
 app.include_router(user_router, prefix='/user')
 app.include_router(activity_router, prefix='/activity')
+app.include_router(metrics_router, prefix='/metrics')
+app.include_router(admin_router, prefix='/admin')
+app.include_router(static_router, prefix='/static', include_in_schema=False)
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+from datetime import timedelta
+
+from db.session import session
+from db.indexes import sync_indexes, index_report
+import model.timeline_model as timeline_model
+import model.user_model as user_model
+import model.activity_model as activity_model
+import model.image_model as image_model
+from job.recommendation_job import run_recommendation_job
+from job.image_gc_job import run_image_gc
+from utils.storage import migrate_flat_files
+
+
+async def indexes(args: argparse.Namespace):
+    if args.sync:
+        errors = await sync_indexes(session.db())
+        for error in errors:
+            print(f'Index sync failed for {error}')
+        if not errors:
+            print('Indexes in sync')
+
+    for entry in await index_report(session.db()):
+        print(f"{entry['collection']:<12} {entry['index']:<28} {entry['status']:<10} ops={entry['ops']}")
+
+
+async def rebuild_timelines(args: argparse.Namespace):
+    await sync_indexes(session.db())
+    rebuilt = await timeline_model.rebuild_all_timelines(args.concurrency)
+    print(f'Rebuilt {rebuilt} timelines')
+
+
+async def backfill_search(args: argparse.Namespace):
+    updated = await user_model.backfill_search_fields(args.batch_size)
+    print(f'Added search fields to {updated} users')
+
+
+async def backfill_friend_count(_args: argparse.Namespace):
+    updated = await user_model.backfill_friend_count()
+    print(f'Added friend_count to {updated} users')
+
+
+async def migrate_activities_array(_args: argparse.Namespace):
+    updated = await activity_model.migrate_activities_array()
+    print(f'Removed the activities array from {updated} users')
+
+
+async def rebuild_image_references(_args: argparse.Namespace):
+    referenced = await image_model.rebuild_references()
+    print(f'Recounted the references of {referenced} images')
+
+
+async def migrate_storage(args: argparse.Namespace):
+    migrated = await asyncio.to_thread(migrate_flat_files, args.workers, args.batch_size)
+    print(f'Moved {migrated} files into the storage')
+
+
+async def gc_images(args: argparse.Namespace):
+    stats = await run_image_gc(timedelta(hours=args.grace_hours), args.batch_size, args.max_per_second, args.dry_run)
+    print(f"{'Would delete' if args.dry_run else 'Deleted'} {stats['deleted']} unreferenced files "
+          f"({stats['deleted_bytes'] / 1024 ** 3:.2f} GB) and {stats['leftovers']} leftover temporary files "
+          f"of {stats['scanned']} scanned")
+
+
+async def compute_recommendations(args: argparse.Namespace):
+    stats = await run_recommendation_job(args.workers, args.chunk_size)
+    print(f"Ranked {stats['users']} users on {stats['workers']} workers in {stats['compute_seconds']:.1f}s "
+          f"(graph loaded in {stats['load_seconds']:.1f}s): {stats['users_per_second']:.0f} users/s, "
+          f"{stats['users_per_second_per_core']:.0f} users/s per core")
+
+
+async def run(args: argparse.Namespace):
+    session.connect()
+    try:
+        await args.handler(args)
+    finally:
+        await session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands for the eco_social API')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('indexes', help='Report missing, undeclared and unused indexes')
+    index_parser.add_argument('--sync', action='store_true', help='Create the declared indexes first')
+    index_parser.set_defaults(handler=indexes)
+
+    rebuild = subparsers.add_parser('rebuild-timelines', help='Backfill feed timelines from the activities collection')
+    rebuild.add_argument('--concurrency', type=int, default=16)
+    rebuild.set_defaults(handler=rebuild_timelines)
+
+    search = subparsers.add_parser('backfill-search', help='Add the username search fields to existing users')
+    search.add_argument('--batch-size', type=int, default=1000)
+    search.set_defaults(handler=backfill_search)
+
+    friend_count = subparsers.add_parser('backfill-friend-count', help='Add friend_count to existing users')
+    friend_count.set_defaults(handler=backfill_friend_count)
+
+    activities = subparsers.add_parser(
+        'migrate-activities-array', help='Replace users.activities with the activity_count counter'
+    )
+    activities.set_defaults(handler=migrate_activities_array)
+
+    image_references = subparsers.add_parser(
+        'rebuild-image-references', help='Recount image references from activities and profile pictures'
+    )
+    image_references.set_defaults(handler=rebuild_image_references)
+
+    storage = subparsers.add_parser(
+        'migrate-storage', help='Move images stored flat in UPLOAD_DIR into the configured storage layout'
+    )
+    storage.add_argument('--workers', type=int, default=8)
+    storage.add_argument('--batch-size', type=int, default=1000)
+    storage.set_defaults(handler=migrate_storage)
+
+    gc = subparsers.add_parser('gc-images', help='Delete stored images nothing references')
+    gc.add_argument('--grace-hours', type=float, default=24, help='Keep files modified more recently than this')
+    gc.add_argument('--batch-size', type=int, default=500)
+    gc.add_argument('--max-per-second', type=float, default=200, help='Upper bound of deleted files per second')
+    gc.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    gc.set_defaults(handler=gc_images)
+
+    recommendations = subparsers.add_parser(
+        'compute-recommendations', help='Precompute friend recommendations for every user'
+    )
+    recommendations.add_argument('--workers', type=int, default=None, help='Defaults to the number of CPUs')
+    recommendations.add_argument('--chunk-size', type=int, default=1000)
+    recommendations.set_defaults(handler=compute_recommendations)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
+import asyncio
+
 from pydantic import BaseModel, Field, ConfigDict
 from enum import IntEnum
 from bson import ObjectId
 from typing import Annotated, Any
 from datetime import datetime, timezone
+from pymongo import DESCENDING, UpdateOne
 
 from db.session import session
+from db.loader import find_by_id, find_by_ids, forget
+from config.settings import settings
 from model.object_id_model import ObjectIdPydanticAnnotation
-from model.user_model import get_user_by_id
+from model.trusted_model import from_document
+from model.user_model import get_friends, get_friend_set, forget_users
+from model.pagination_model import ActivityIdPage, after_cursor, to_page, DEFAULT_PAGE_SIZE
+import model.timeline_model as timeline_model
+from utils.image_processor import select_variant
 
 
 class ActivityType(IntEnum):
@@ -62,12 +71,18 @@ class ActivityBaseModel(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
+class ImageVariants(BaseModel):
+    image: str
+    variants: dict[int, str]  # width -> filename
+
+
 class NewActivityModel(ActivityBaseModel):
     user_id: Annotated[ObjectId, ObjectIdPydanticAnnotation]
     username: str
     points_gained: int
     streak_snapshot: int
     images: list[str] = []
+    image_variants: list[ImageVariants] = []  # filled in after the upload, see utils/image_processor.py
 
 
 class ActivityModel(NewActivityModel):
@@ -76,62 +91,159 @@ class ActivityModel(NewActivityModel):
     model_config = ConfigDict(populate_by_name=True)
 
 
-def create_activity(activity: NewActivityModel):
-    inserted_id = session.activities_collection().insert_one(activity.model_dump()).inserted_id
-    return inserted_id
+    # images replaced with the variants closest to the requested width
+    def with_image_width(self, width: int | None) -> 'ActivityModel':
+        if width is None:
+            return self
+
+        variants = {image_variants.image: image_variants.variants for image_variants in self.image_variants}
+        images = [select_variant(image, variants.get(image, {}), width) for image in self.images]
+        return self.model_copy(update={'images': images})
+
+
+class ActivityPage(BaseModel):
+    items: list[ActivityModel]
+    next_cursor: str | None = None
+
+
+# Matches the user_id_created_at_id index declared in db/indexes.py
+TIMELINE_SORT = [('created_at', DESCENDING), ('_id', DESCENDING)]
 
 
-def get_activity_by_id(activity_id: str) -> ActivityModel | None:
-    result: dict[str, Any] | None = session.activities_collection().find_one({'_id': ObjectId(activity_id)})
+async def create_activity(activity: NewActivityModel) -> ObjectId:
+    return (await session.activities_collection().insert_one(activity.model_dump())).inserted_id
+
+
+# Called once the activity is stored, pushes it to the timelines of the author's friends
+async def publish_activity(activity: NewActivityModel, activity_id: ObjectId) -> None:
+    if settings.feed_timelines_enabled:
+        await timeline_model.fan_out(activity.user_id, activity_id, activity.created_at)
+
+
+async def get_activity_by_id(activity_id: str) -> ActivityModel | None:
+    result: dict[str, Any] | None = await find_by_id('activities', ObjectId(activity_id))
 
     if result is None:
         return None
 
-    return ActivityModel(**result)
+    return from_document(ActivityModel, result)
 
 
-def update_activity(activity_id: str, title: str, caption: str, images: list[str]) -> bool:
-    modified_count = session.activities_collection().update_one(
+async def get_activities_by_ids(activity_ids: list[str]) -> list[ActivityModel]:
+    object_ids = list(dict.fromkeys(map(ObjectId, activity_ids)))
+    results = await find_by_ids('activities', object_ids)
+
+    by_id = {result['_id']: result for result in results}
+    return [from_document(ActivityModel, by_id[_id]) for _id in object_ids if _id in by_id]
+
+
+# Activities are visible to their owner and the owner's friends, one friends lookup covers the whole batch
+async def get_visible_activities(viewer_id: str, activity_ids: list[str]) -> list[ActivityModel]:
+    if not activity_ids:
+        return []
+
+    activities, friends = await asyncio.gather(get_activities_by_ids(activity_ids), get_friend_set(viewer_id))
+    visible_owners = friends | {ObjectId(viewer_id)}
+    return [activity for activity in activities if activity.user_id in visible_owners]
+
+
+async def update_activity(activity_id: str, title: str, caption: str, images: list[str]) -> bool:
+    modified_count = (await session.activities_collection().update_one(
         {'_id': ObjectId(activity_id)},
         {'$set': {
             'title': title,
             'caption': caption,
             'images': images
+        }, '$pull': {
+            'image_variants': {'image': {'$nin': images}}
         }}
-    ).modified_count
+    )).modified_count
+    forget('activities', ObjectId(activity_id))
     return modified_count == 1
 
 
-def delete_activity(activity_id: str, user_id: str) -> bool:
-    deleted_count = session.activities_collection().delete_one({'_id': ObjectId(activity_id)}).deleted_count
-    modified_count = session.users_collection().update_one(
+# Only recorded while the image is still part of the activity
+async def add_image_variants(activity_id: str, variants: dict[str, dict[int, str]]) -> None:
+    if not variants:
+        return
+
+    await asyncio.gather(*(
+        session.activities_collection().update_one(
+            {'_id': ObjectId(activity_id), 'images': image, 'image_variants.image': {'$ne': image}},
+            {'$push': {'image_variants': {
+                'image': image,
+                'variants': {str(width): filename for width, filename in image_variants.items()}
+            }}}
+        ) for image, image_variants in variants.items()
+    ))
+    forget('activities', ObjectId(activity_id))
+
+
+async def delete_activity(activity_id: str, user_id: str) -> bool:
+    deleted_count = (await session.activities_collection().delete_one({'_id': ObjectId(activity_id)})).deleted_count
+    forget('activities', ObjectId(activity_id))
+    if deleted_count != 1:
+        return False
+
+    await session.users_collection().update_one(
         {'_id': ObjectId(user_id)},
-        {'$pull': {'activities': ObjectId(activity_id)}}
-    ).modified_count
-    return deleted_count == 1 and modified_count == 1
+        {'$inc': {'activity_count': -1}}
+    )
+    forget_users(user_id)
 
+    if settings.feed_timelines_enabled:
+        await timeline_model.remove_activity(ObjectId(activity_id))
 
-def get_user_activities(user_id: str) -> list[str]:
-    results = session.activities_collection().find({'user_id': ObjectId(user_id)}, {'_id': 1}).sort('created_at', -1)
+    return True
 
-    if results is None:
-        return []
 
-    activity_ids = [str(result['_id']) for result in results]
-    return activity_ids
+# Replaces the users.activities array (a copy of activities.user_id) with the activity_count counter.
+# Every user is written once: users with activities get their count, the others a 0 if they have no counter yet,
+# so the counters the app $inc's meanwhile are kept. An activity created or deleted between the aggregation and the
+# write of its author's count is still lost, run it with the app stopped for exact counts.
+async def migrate_activities_array() -> int:
+    counts = await (await session.activities_collection().aggregate([
+        {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}}
+    ])).to_list()
 
+    if counts:
+        await session.users_collection().bulk_write([
+            UpdateOne({'_id': count['_id']}, {'$set': {'activity_count': count['count']}}) for count in counts
+        ], ordered=False)
+    await session.users_collection().update_many(
+        {'activity_count': {'$exists': False}}, {'$set': {'activity_count': 0}}
+    )
 
-def get_feed(user_id: str) -> list[str]:
-    user = get_user_by_id(user_id)
+    return (await session.users_collection().update_many(
+        {'activities': {'$exists': True}}, {'$unset': {'activities': ''}}
+    )).modified_count
 
-    if not user:
-        return []
 
-    friends = user.friends
+async def get_user_activities(
+        user_id: str, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE
+) -> ActivityIdPage:
+    query = after_cursor({'user_id': ObjectId(user_id)}, cursor)
+    results = await session.activities_collection().find(
+        query, {'_id': 1, 'created_at': 1}
+    ).sort(TIMELINE_SORT).limit(limit + 1).to_list()
 
-    results = session.activities_collection().find({'user_id': {'$in': friends}}, {'_id': 1}).sort('created_at', -1)
-    if results is None:
-        return []
+    return to_page(results, limit)
+
+
+async def get_feed(user_id: str, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE) -> ActivityIdPage:
+    if settings.feed_timelines_enabled:
+        page = await timeline_model.get_timeline_page(user_id, cursor, limit)
+        if page is not None:
+            return page
+
+    friends = await get_friends(user_id)
+
+    if not friends:
+        return ActivityIdPage(items=[])
+
+    query = after_cursor({'user_id': {'$in': friends}}, cursor)
+    results = await session.activities_collection().find(
+        query, {'_id': 1, 'created_at': 1}
+    ).sort(TIMELINE_SORT).limit(limit + 1).to_list()
 
-    activity_ids = [str(result['_id']) for result in results]
-    return activity_ids
+    return to_page(results, limit)
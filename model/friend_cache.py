@@ -0,0 +1,83 @@
+# In-process cache of friend sets used by the authorization checks (is_user_friend, get_visible_activities).
+# Entries are evicted least recently used once the cache holds more than FRIEND_CACHE_MAX_IDS friend ids in total and
+# expire after FRIEND_CACHE_TTL_SECONDS, which bounds how stale a friendship changed on another worker can be seen here.
+# Changes made through this worker invalidate the affected users right away.
+import time
+from collections import OrderedDict
+from typing import Any
+
+from bson import ObjectId
+
+from config.settings import settings
+
+
+class FriendCache:
+    def __init__(self):
+        self._entries: OrderedDict[str, tuple[float, frozenset[ObjectId]]] = OrderedDict()
+        self._size = 0
+        # bumped on every invalidation, a load that started before an invalidation must not be cached
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.friend_cache_ttl_seconds > 0 and settings.friend_cache_max_ids > 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: str) -> frozenset[ObjectId] | None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, friends = entry
+        if expires_at < time.monotonic():
+            self._remove(user_id)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return friends
+
+    def put(self, user_id: str, friends: frozenset[ObjectId], generation: int):
+        if not self.enabled or generation != self._generation or len(friends) > settings.friend_cache_max_ids:
+            return
+
+        self._remove(user_id)
+        self._entries[user_id] = (time.monotonic() + settings.friend_cache_ttl_seconds, friends)
+        self._size += len(friends)
+
+        while self._size > settings.friend_cache_max_ids:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, *user_ids: str):
+        self._generation += 1
+        for user_id in user_ids:
+            self._remove(user_id)
+
+    def _remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'cached_ids': self._size,
+            'max_ids': settings.friend_cache_max_ids,
+            'ttl_seconds': settings.friend_cache_ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+friend_cache: FriendCache = FriendCache()
@@ -0,0 +1,110 @@
+# Reference counts of the stored images: {'_id': filename, 'refs': int, 'variants': {width: filename}, 'updated_at'}
+# Images are content addressed ({sha256}.{ext}), so the same picture uploaded twice is stored once. Every occurrence
+# of a filename in activities.images or users.profile_pic holds one reference, the file is deleted with its last one.
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator
+
+from pymongo import UpdateOne
+
+from db.session import session
+
+
+async def add_references(filenames: list[str]) -> None:
+    if not filenames:
+        return
+
+    now = datetime.now(timezone.utc)
+    await session.images_collection().bulk_write([
+        UpdateOne({'_id': filename}, {'$inc': {'refs': count}, '$set': {'updated_at': now}}, upsert=True)
+        for filename, count in Counter(filenames).items()
+    ], ordered=False)
+
+
+# Returns the images that are no longer referenced
+async def remove_references(filenames: list[str]) -> list[dict[str, Any]]:
+    if not filenames:
+        return []
+
+    counts = Counter(filenames)
+    now = datetime.now(timezone.utc)
+    await session.images_collection().bulk_write([
+        UpdateOne({'_id': filename}, {'$inc': {'refs': -count}, '$set': {'updated_at': now}})
+        for filename, count in counts.items()
+    ], ordered=False)
+
+    return await session.images_collection().find(
+        {'_id': {'$in': list(counts)}, 'refs': {'$lte': 0}}, {'variants': 1}
+    ).to_list()
+
+
+# Succeeds only if nobody referenced the image again in the meantime
+async def delete_unreferenced(filename: str) -> bool:
+    return (await session.images_collection().delete_one({'_id': filename, 'refs': {'$lte': 0}})).deleted_count == 1
+
+
+async def get_variants(filenames: list[str]) -> dict[str, dict[int, str]]:
+    results = await session.images_collection().find(
+        {'_id': {'$in': filenames}, 'variants': {'$exists': True}}, {'variants': 1}
+    ).to_list()
+    return {
+        result['_id']: {int(width): filename for width, filename in result['variants'].items()} for result in results
+    }
+
+
+async def set_variants(variants: dict[str, dict[int, str]]) -> None:
+    if not variants:
+        return
+
+    await session.images_collection().bulk_write([
+        UpdateOne({'_id': filename}, {'$set': {
+            'variants': {str(width): variant for width, variant in image_variants.items()}
+        }}) for filename, image_variants in variants.items()
+    ], ordered=False)
+
+
+# Every filename in activities.images and users.profile_pic, once per reference
+async def referenced_filenames() -> AsyncIterator[str]:
+    async for activity in session.activities_collection().find({'images.0': {'$exists': True}}, {'images': 1}):
+        for filename in activity['images']:
+            yield filename
+    async for user in session.users_collection().find({'profile_pic': {'$nin': ['', None]}}, {'profile_pic': 1}):
+        yield user['profile_pic']
+
+
+async def get_updated_since(since: datetime) -> list[str]:
+    return [result['_id'] for result in await session.images_collection().find(
+        {'updated_at': {'$gte': since}}, {'_id': 1}
+    ).to_list()]
+
+
+# Counts of images deleted by the garbage collector, unless somebody referenced them since it started
+async def delete_counts(filenames: list[str], unchanged_since: datetime) -> None:
+    await session.images_collection().delete_many({'_id': {'$in': filenames}, 'updated_at': {'$lt': unchanged_since}})
+
+
+# Recounts the references from activities and users, e.g. for images uploaded before the counts existed
+async def rebuild_references() -> int:
+    counts = Counter()
+    async for result in await session.activities_collection().aggregate([
+        {'$unwind': '$images'},
+        {'$group': {'_id': '$images', 'refs': {'$sum': 1}}}
+    ]):
+        counts[result['_id']] += result['refs']
+    async for result in await session.users_collection().aggregate([
+        {'$match': {'profile_pic': {'$nin': ['', None]}}},
+        {'$group': {'_id': '$profile_pic', 'refs': {'$sum': 1}}}
+    ]):
+        counts[result['_id']] += result['refs']
+
+    now = datetime.now(timezone.utc)
+    await session.images_collection().update_many(
+        {'_id': {'$nin': list(counts)}}, {'$set': {'refs': 0, 'updated_at': now}}
+    )
+    if counts:
+        await session.images_collection().bulk_write([
+            UpdateOne({'_id': filename}, {'$set': {'refs': refs, 'updated_at': now}}, upsert=True)
+            for filename, refs in counts.items()
+        ], ordered=False)
+
+    return len(counts)
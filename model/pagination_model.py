@@ -0,0 +1,69 @@
+from pydantic import BaseModel
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import Any
+from datetime import datetime, timezone
+import base64
+import binascii
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class ActivityIdPage(BaseModel):
+    items: list[str]
+    next_cursor: str | None = None
+
+
+# The cursor is opaque for the clients, internally it is the (created_at, _id) pair of the last returned activity
+def encode_cursor(created_at: datetime, _id: ObjectId) -> str:
+    millis = int(created_at.replace(tzinfo=created_at.tzinfo or timezone.utc).timestamp() * 1000)
+    raw = f'{millis}:{_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        millis, _id = raw.split(':')
+        return datetime.fromtimestamp(int(millis) / 1000, timezone.utc), ObjectId(_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise ValueError('Invalid cursor')
+
+
+# Cursor over (username_lower, _id) used by the user search
+def encode_key_cursor(key: str, _id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(f'{_id}:{key}'.encode()).decode().rstrip('=')
+
+
+def decode_key_cursor(cursor: str) -> tuple[str, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        _id, key = raw.split(':', 1)
+        return key, ObjectId(_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise ValueError('Invalid cursor')
+
+
+def after_cursor(query: dict[str, Any], cursor: str | None) -> dict[str, Any]:
+    if cursor is None:
+        return query
+
+    created_at, _id = decode_cursor(cursor)
+    return {
+        **query,
+        '$or': [
+            {'created_at': {'$lt': created_at}},
+            {'created_at': created_at, '_id': {'$lt': _id}}
+        ]
+    }
+
+
+def to_page(results: list[dict[str, Any]], limit: int) -> ActivityIdPage:
+    # results were fetched with limit + 1, the extra document only tells us if there is a next page
+    has_next = len(results) > limit
+    results = results[:limit]
+
+    next_cursor = encode_cursor(results[-1]['created_at'], results[-1]['_id']) if has_next else None
+    return ActivityIdPage(items=[str(result['_id']) for result in results], next_cursor=next_cursor)
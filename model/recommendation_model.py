@@ -0,0 +1,34 @@
+# Friend recommendations precomputed by job/recommendation_job.py
+# {'_id': user_id, 'recommended': [user_id, ...] (best first), 'computed_at': datetime}
+from bson import ObjectId
+from pymongo import ReplaceOne
+from datetime import datetime, timezone, timedelta
+
+from db.session import session
+from config.settings import settings
+
+
+# The endpoint allows at most 10 recommendations, a few extra leave room for the ones that became friends since
+STORED_RECOMMENDATIONS = 20
+
+
+async def get_recommended_ids(user_id: str) -> list[ObjectId] | None:
+    result = await session.recommendations_collection().find_one({'_id': ObjectId(user_id)})
+    if result is None:
+        return None
+
+    max_age = timedelta(hours=settings.recommendations_max_age_hours)
+    if datetime.now(timezone.utc) - result['computed_at'].replace(tzinfo=timezone.utc) > max_age:
+        return None  # stale, the caller computes them online
+
+    return result['recommended']
+
+
+async def save_recommendations(recommendations: list[tuple[ObjectId, list[ObjectId]]], computed_at: datetime):
+    if not recommendations:
+        return
+
+    await session.recommendations_collection().bulk_write([
+        ReplaceOne({'_id': user_id}, {'recommended': recommended, 'computed_at': computed_at}, upsert=True)
+        for user_id, recommended in recommendations
+    ], ordered=False)
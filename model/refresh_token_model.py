@@ -0,0 +1,38 @@
+# Refresh tokens are stored only as their sha256 digest:
+# {'_id': digest, 'user_id', 'username', 'family_id', 'expires_at', 'rotated_at'}
+# Every refresh rotates the token. All tokens issued from one login share a family_id, so presenting an already
+# rotated token (a stolen copy) revokes the whole family.
+from typing import Any
+from datetime import datetime, timezone
+
+from db.session import session
+
+
+async def store_refresh_token(
+        token_hash: str, user_id: str, username: str, family_id: str, expires_at: datetime
+) -> None:
+    await session.refresh_tokens_collection().insert_one({
+        '_id': token_hash,
+        'user_id': user_id,
+        'username': username,
+        'family_id': family_id,
+        'expires_at': expires_at,
+        'rotated_at': None
+    })
+
+
+# Marks the token as used and returns it, or None if it is unknown, expired or already rotated
+async def rotate_refresh_token(token_hash: str) -> dict[str, Any] | None:
+    now = datetime.now(timezone.utc)
+    return await session.refresh_tokens_collection().find_one_and_update(
+        {'_id': token_hash, 'rotated_at': None, 'expires_at': {'$gt': now}},
+        {'$set': {'rotated_at': now}}
+    )
+
+
+async def get_refresh_token(token_hash: str) -> dict[str, Any] | None:
+    return await session.refresh_tokens_collection().find_one({'_id': token_hash})
+
+
+async def revoke_family(family_id: str) -> None:
+    await session.refresh_tokens_collection().delete_many({'family_id': family_id})
@@ -1,13 +1,37 @@
-from pydantic import BaseModel, Field
+from bson import ObjectId
+from fastapi import Query
+from pydantic import AfterValidator, BaseModel, Field
 from typing import Annotated
 
+from model.pagination_model import MAX_PAGE_SIZE
 
-ObjectIdStr = Annotated[str, Field(min_length=24, max_length=24)]
+
+def check_object_id(value: str) -> str:
+    if not ObjectId.is_valid(value):
+        raise ValueError('Invalid id')
+    return value
+
+
+# Rejected with 422 unless it is 24 hex characters, so ObjectId() can't raise InvalidId in the handlers
+ObjectIdStr = Annotated[str, Field(min_length=24, max_length=24), AfterValidator(check_object_id)]
+
+ABOUT_ME_MAX_LENGTH = 1000
+
+# Selects the resized variant of the returned images, see utils/image_processor.py
+ImageWidth = Annotated[int | None, Query(ge=1)]
 
 
 class UserIdBody(BaseModel):
     user_id: ObjectIdStr
 
 
+class ActivityIdsBody(BaseModel):
+    activity_ids: Annotated[list[ObjectIdStr], Field(max_length=MAX_PAGE_SIZE)]
+
+
+class RefreshTokenBody(BaseModel):
+    refresh_token: str
+
+
 class AboutMeBody(BaseModel):
-    about_me: ObjectIdStr
+    about_me: Annotated[str, Field(max_length=ABOUT_ME_MAX_LENGTH)]
@@ -0,0 +1,132 @@
+# Materialized feed timelines (fan-out on write).
+# Every user has at most one timeline document: {'_id': user_id, 'items': [{activity_id, user_id, created_at}]}
+# where items are the newest activities of their friends, sorted newest first and capped at timeline_max_length.
+import asyncio
+
+from bson import ObjectId
+from pymongo import DESCENDING, UpdateOne
+from typing import Any
+from datetime import datetime, timezone
+
+from db.session import session
+from db.loader import find_by_id
+from config.settings import settings
+from model.pagination_model import ActivityIdPage, decode_cursor, to_page
+
+
+ITEMS_SORT = {'created_at': DESCENDING, 'activity_id': DESCENDING}
+
+
+def _push_items(items: list[dict[str, Any]]) -> dict[str, Any]:
+    return {'$push': {'items': {
+        '$each': items,
+        '$sort': ITEMS_SORT,
+        '$slice': settings.timeline_max_length
+    }}}
+
+
+def _to_item(activity: dict[str, Any]) -> dict[str, Any]:
+    return {'activity_id': activity['_id'], 'user_id': activity['user_id'], 'created_at': activity['created_at']}
+
+
+async def _get_friend_ids(user_id: ObjectId) -> list[ObjectId]:
+    result = await find_by_id('users', user_id, ['friends'])
+    if result is None:
+        return []
+    return result.get('friends', [])
+
+
+async def _get_recent_activities(user_ids: list[ObjectId], amount: int) -> list[dict[str, Any]]:
+    return await session.activities_collection().find(
+        {'user_id': {'$in': user_ids}}, {'_id': 1, 'user_id': 1, 'created_at': 1}
+    ).sort([('created_at', DESCENDING), ('_id', DESCENDING)]).limit(amount).to_list()
+
+
+async def fan_out(author_id: ObjectId, activity_id: ObjectId, created_at: datetime) -> None:
+    friends = await _get_friend_ids(author_id)
+    if not friends:
+        return
+
+    update = _push_items([{'activity_id': activity_id, 'user_id': author_id, 'created_at': created_at}])
+    await session.timelines_collection().bulk_write(
+        [UpdateOne({'_id': friend_id}, update, upsert=True) for friend_id in friends],
+        ordered=False
+    )
+
+
+async def remove_activity(activity_id: ObjectId) -> None:
+    await session.timelines_collection().update_many(
+        {'items.activity_id': activity_id},
+        {'$pull': {'items': {'activity_id': activity_id}}}
+    )
+
+
+async def remove_friend_items(my_id: ObjectId, friend_id: ObjectId) -> None:
+    await session.timelines_collection().bulk_write([
+        UpdateOne({'_id': my_id}, {'$pull': {'items': {'user_id': friend_id}}}),
+        UpdateOne({'_id': friend_id}, {'$pull': {'items': {'user_id': my_id}}})
+    ], ordered=False)
+
+
+async def backfill_friendship(my_id: ObjectId, friend_id: ObjectId) -> None:
+    my_recent, friend_recent = await asyncio.gather(
+        _get_recent_activities([my_id], settings.timeline_backfill_count),
+        _get_recent_activities([friend_id], settings.timeline_backfill_count)
+    )
+
+    requests = []
+    if friend_recent:
+        requests.append(UpdateOne({'_id': my_id}, _push_items(list(map(_to_item, friend_recent))), upsert=True))
+    if my_recent:
+        requests.append(UpdateOne({'_id': friend_id}, _push_items(list(map(_to_item, my_recent))), upsert=True))
+
+    if requests:
+        await session.timelines_collection().bulk_write(requests, ordered=False)
+
+
+async def get_timeline_page(user_id: str, cursor: str | None, limit: int) -> ActivityIdPage | None:
+    result = await session.timelines_collection().find_one({'_id': ObjectId(user_id)}, {'items': 1})
+
+    if result is None:
+        return None  # timeline not materialized yet
+
+    items = result.get('items', [])
+    if cursor is not None:
+        created_at, _id = decode_cursor(cursor)
+        items = [
+            item for item in items
+            if (item['created_at'].replace(tzinfo=timezone.utc), item['activity_id']) < (created_at, _id)
+        ]
+
+    page = [{'_id': item['activity_id'], 'created_at': item['created_at']} for item in items[:limit + 1]]
+    return to_page(page, limit)
+
+
+async def rebuild_timeline(user_id: ObjectId, friends: list[ObjectId]) -> None:
+    recent = await _get_recent_activities(friends, settings.timeline_max_length) if friends else []
+    await session.timelines_collection().replace_one(
+        {'_id': user_id},
+        {'items': list(map(_to_item, recent))},
+        upsert=True
+    )
+
+
+async def rebuild_all_timelines(concurrency: int = 16) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+    rebuilt = 0
+
+    async def rebuild(user: dict[str, Any]):
+        nonlocal rebuilt
+        async with semaphore:
+            await rebuild_timeline(user['_id'], user.get('friends', []))
+            rebuilt += 1
+
+    tasks = []
+    async for user in session.users_collection().find({}, {'friends': 1}):
+        tasks.append(asyncio.create_task(rebuild(user)))
+        if len(tasks) >= concurrency * 16:
+            await asyncio.gather(*tasks)
+            tasks = []
+    await asyncio.gather(*tasks)
+
+    return rebuilt
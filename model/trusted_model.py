@@ -0,0 +1,63 @@
+# Builds models from documents read from our own database without validating them again.
+# Every document was validated when it was written, so UserModel(**document) only costs time: the validator of
+# ObjectIdPydanticAnnotation runs for every element of friends. from_document() uses model_construct instead and only
+# converts what the database can't represent (nested models, enums, integer keys of dicts).
+# Never use it for data coming from clients.
+from enum import Enum
+from functools import cache
+from types import UnionType
+from typing import Any, Annotated, Callable, TypeVar, Union, get_args, get_origin
+
+from pydantic import BaseModel
+
+
+Model = TypeVar('Model', bound=BaseModel)
+
+
+def from_document(model: type[Model], document: dict[str, Any]) -> Model:
+    values = {}
+    for name, key, convert in _plan(model):
+        if key in document:
+            value = document[key]
+            values[name] = convert(value) if convert is not None and value is not None else value
+    return model.model_construct(**values)
+
+
+# (field name, key in the document, converter or None) for every field of the model
+@cache
+def _plan(model: type[BaseModel]) -> list[tuple[str, str, Callable[[Any], Any] | None]]:
+    return [
+        (name, field.alias or name, _converter(field.annotation))
+        for name, field in model.model_fields.items()
+    ]
+
+
+def _converter(annotation: Any) -> Callable[[Any], Any] | None:
+    origin, args = get_origin(annotation), get_args(annotation)
+
+    if origin is Annotated:
+        return _converter(args[0])
+
+    if origin in (Union, UnionType):
+        converters = [_converter(arg) for arg in args if arg is not type(None)]
+        return converters[0] if len(converters) == 1 else None
+
+    if origin is list:
+        item = _converter(args[0]) if args else None
+        return (lambda values: [item(value) for value in values]) if item is not None else None
+
+    if origin is dict and args:
+        item = _converter(args[1])
+        if args[0] is int:
+            if item is None:
+                return lambda values: {int(key): value for key, value in values.items()}
+            return lambda values: {int(key): item(value) for key, value in values.items()}
+        return (lambda values: {key: item(value) for key, value in values.items()}) if item is not None else None
+
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return lambda value: from_document(annotation, value) if isinstance(value, dict) else value
+
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return annotation
+
+    return None
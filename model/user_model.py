@@ -1,36 +1,25 @@
 import heapq
+import re
+from collections import Counter
 
 from pydantic import BaseModel, ConfigDict
-from typing import Any, Annotated
+from typing import Any, Annotated, Callable, Iterable, Hashable
 from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument
 
 from db.session import session
-from datetime import datetime, timezone
+from db.loader import find_by_id, find_by_ids, forget, to_projection
+from config.settings import settings
+import model.timeline_model as timeline_model
+import model.recommendation_model as recommendation_model
+from model.friend_cache import friend_cache
+from datetime import datetime, timezone, timedelta
 from pydantic import Field
 
 from model.object_id_model import ObjectIdPydanticAnnotation
-
-
-class FriendCloseness:
-    def __init__(self, _id: str):
-        self._id = _id
-        self.count = 0
-
-    def __hash__(self):
-        return hash(self._id)
-
-    def __eq__(self, other):
-        if self.id == other.id:
-            self.count += 1
-            return True
-        return False
-
-    def __lt__(self, other):
-        return self.count < other.count
-
-    @property
-    def id(self):
-        return self._id
+from model.trusted_model import from_document
+from model.pagination_model import encode_key_cursor, decode_key_cursor
+from utils.image_processor import select_variant
 
 
 class FriendshipRequest(BaseModel):
@@ -45,17 +34,25 @@ class BaseUserModel(BaseModel):
     streak: int = 0
     points: int = 0
     profile_pic: str = ''
+    profile_pic_variants: dict[int, str] = {}  # width -> filename, see utils/image_processor.py
     about_me: str = ''
 
     model_config = ConfigDict(populate_by_name=True)
 
+    # profile_pic replaced with the variant closest to the requested width
+    def with_image_width(self, width: int | None):
+        if width is None:
+            return self
+        profile_pic = select_variant(self.profile_pic, self.profile_pic_variants, width)
+        return self.model_copy(update={'profile_pic': profile_pic})
+
 
 class PublicUserModel(BaseUserModel):  # The way anyone can see you
     friend_count: int = 0
 
 
 class PrivateUserModel(BaseUserModel):  # The way your friends see you
-    activities: list[Annotated[ObjectId, ObjectIdPydanticAnnotation]] = []
+    activity_count: int = 0  # the activities themselves are listed by GET /activity/activities/{user_id}
     friends: list[Annotated[ObjectId, ObjectIdPydanticAnnotation]] = []
 
 
@@ -65,133 +62,244 @@ class UserModel(PrivateUserModel):  # The way only you can see yourself
     last_time_on_streak: datetime | None = None
 
 
+class UserSearchPage(BaseModel):
+    items: list[PublicUserModel]
+    next_cursor: str | None = None
+
+
+MAX_SEARCH_RESULTS = 50
+MIN_SUBSTRING_SEARCH_LENGTH = 3
+
+
+# Fields each model is built from, so no caller reads the unbounded arrays it doesn't show
+PUBLIC_USER_FIELDS = ('username', 'streak', 'points', 'profile_pic', 'profile_pic_variants', 'about_me', 'friend_count')
+PRIVATE_USER_FIELDS = (
+    'username', 'streak', 'points', 'profile_pic', 'profile_pic_variants', 'about_me', 'activity_count', 'friends'
+)
+
+
 # Functions related to the user itself
-def get_user_by_id(user_id: str) -> UserModel | None:
-    result: dict[str, Any] | None = session.users_collection().find_one({'_id': ObjectId(user_id)})
+def forget_users(*user_ids: str | ObjectId):
+    forget('users', *map(ObjectId, user_ids))
+
+
+async def get_user_by_id(user_id: str) -> UserModel | None:
+    result: dict[str, Any] | None = await find_by_id('users', ObjectId(user_id))
 
     if result is None:
         return None
 
-    return UserModel(**result)
+    return from_document(UserModel, result)
 
 
-def get_user_id_by_username(username: str) -> str | None:
-    result = session.users_collection().find_one({'username': username})
+async def get_user_id_by_username(username: str) -> str | None:
+    result = await session.users_collection().find_one({'username': username})
 
     if result is None:
         return None
     return str(result['_id'])
 
 
-def search_users(username_search: str) -> list[PublicUserModel]:
-    results = session.users_collection().find({'username': {'$regex': username_search, '$options': 'i'}})
+def normalize_username(username: str) -> str:
+    return username.lower()
 
-    if not results:
-        return []
 
-    users = []
-    for user in results:
-        friend_count = len(user['friends']) if 'friends' in user else 0
-        users.append(PublicUserModel(**{**user, 'friend_count': friend_count}))
+def username_trigrams(normalized_username: str) -> list[str]:
+    return sorted({normalized_username[i:i + 3] for i in range(len(normalized_username) - 2)})
 
-    return users
 
+def search_fields(username: str) -> dict[str, Any]:
+    normalized = normalize_username(username)
+    return {'username_lower': normalized, 'username_trigrams': username_trigrams(normalized)}
 
-def get_user_password_by_username(username: str) -> str | None:
-    result = session.users_collection().find_one({'username': username})
+
+# The filter and the index of a search page. Both are ordered by (username_lower, _id), so the index scan stops
+# after the page instead of sorting every candidate in memory. The index is hinted: username_lower_id also gives
+# that order and the planner could prefer it for a substring search, scanning every user.
+def search_query(normalized: str, cursor: str | None = None, substring: bool = False) -> tuple[dict[str, Any], str]:
+    if substring:
+        # the index scan is bounded to the users with the first trigram, the others and the regex filter the
+        # entries (a trigram match doesn't mean the trigrams are contiguous)
+        query = {
+            'username_trigrams': {'$all': username_trigrams(normalized)},
+            'username_lower': {'$regex': re.escape(normalized)}
+        }
+        index = 'username_trigrams_lower_id'
+    else:
+        # anchored and case-sensitive on the normalized field, so it is a range scan on username_lower_id
+        query = {'username_lower': {'$regex': '^' + re.escape(normalized)}}
+        index = 'username_lower_id'
+
+    if cursor is not None:
+        key, _id = decode_key_cursor(cursor)
+        query['$or'] = [{'username_lower': {'$gt': key}}, {'username_lower': key, '_id': {'$gt': _id}}]
+
+    return query, index
+
+
+SEARCH_SORT = [('username_lower', 1), ('_id', 1)]
+
+
+async def search_users(
+        username_search: str, cursor: str | None = None, limit: int = 20, substring: bool = False
+) -> UserSearchPage:
+    query, index = search_query(normalize_username(username_search), cursor, substring)
+
+    limit = min(limit, MAX_SEARCH_RESULTS)
+    results = await session.users_collection().find(
+        query, to_projection([*PUBLIC_USER_FIELDS, 'username_lower'])
+    ).sort(SEARCH_SORT).hint(index).limit(limit + 1).to_list()
+
+    has_next = len(results) > limit
+    results = results[:limit]
+    next_cursor = encode_key_cursor(results[-1]['username_lower'], results[-1]['_id']) if has_next else None
+    return UserSearchPage(items=[from_document(PublicUserModel, result) for result in results], next_cursor=next_cursor)
+
+
+async def backfill_friend_count() -> int:
+    result = await session.users_collection().update_many(
+        {'friend_count': {'$exists': False}},
+        [{'$set': {'friend_count': {'$size': {'$ifNull': ['$friends', []]}}}}]
+    )
+    return result.modified_count
+
+
+async def backfill_search_fields(batch_size: int = 1000) -> int:
+    updated = 0
+    batch = []
+    async for user in session.users_collection().find({'username_lower': {'$exists': False}}, {'username': 1}):
+        batch.append(UpdateOne({'_id': user['_id']}, {'$set': search_fields(user['username'])}))
+        if len(batch) >= batch_size:
+            updated += (await session.users_collection().bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await session.users_collection().bulk_write(batch, ordered=False)).modified_count
+    return updated
+
+
+async def get_user_credentials_by_username(username: str) -> tuple[str, str] | None:
+    result = await session.users_collection().find_one({'username': username}, {'password_hash': 1})
 
     if result is None:
         return None
-    return result['password_hash']
+    return str(result['_id']), result['password_hash']
 
 
-def create_user(username: str, password_hash: str) -> bool:
+async def create_user(username: str, password_hash: str) -> bool:
 
-    inserted_id = session.users_collection().insert_one({
+    inserted_id = (await session.users_collection().insert_one({
         'username': username,
-        'password_hash': password_hash
-    }).inserted_id
+        'password_hash': password_hash,
+        **search_fields(username)
+    })).inserted_id
 
     return bool(inserted_id)
 
 
-def get_public_user(user_id: str) -> PublicUserModel | None:
-    result = session.users_collection().find_one({'_id': ObjectId(user_id)})
+async def get_public_user(user_id: str) -> PublicUserModel | None:
+    result = await find_by_id('users', ObjectId(user_id), PUBLIC_USER_FIELDS)
     if not result:
         return None
-    friend_count = len(result['friends']) if 'friends' in result.keys() else 0
-    result = {**result, 'friend_count': friend_count}
-    return PublicUserModel(**result)
+    return from_document(PublicUserModel, result)
 
 
-def get_private_user(user_id: str) -> PrivateUserModel | None:
-    result = session.users_collection().find_one({'_id': ObjectId(user_id)})
+async def get_private_user(user_id: str) -> PrivateUserModel | None:
+    result = await find_by_id('users', ObjectId(user_id), PRIVATE_USER_FIELDS)
     if not result:
         return None
-    return PrivateUserModel(**result)
+    return from_document(PrivateUserModel, result)
+
 
+STREAK_WINDOW = timedelta(hours=48)
 
-def update_after_activity_creation(
-        user_id: str, new_points: int, new_streak: int, new_last_time_on_streak: datetime, activity_id: ObjectId
-) -> bool:
 
-    modified_count = session.users_collection().update_one(
+# Aggregation pipeline update run by the server against the current document, so concurrent activities of the
+# same user can't overwrite each other's points or streak. A missing or null last_time_on_streak compares lower
+# than any date, which restarts the streak at 1.
+def activity_creation_update(points_gained: int) -> list[dict[str, Any]]:
+    window_start = {'$subtract': ['$$NOW', int(STREAK_WINDOW.total_seconds() * 1000)]}
+    return [{'$set': {
+        'streak': {'$cond': [
+            {'$gt': ['$last_time_on_streak', window_start]},
+            {'$add': [{'$ifNull': ['$streak', 0]}, 1]},
+            1
+        ]},
+        'last_time_on_streak': '$$NOW',
+        'points': {'$add': [{'$ifNull': ['$points', 0]}, points_gained]},
+        'activity_count': {'$add': [{'$ifNull': ['$activity_count', 0]}, 1]}
+    }}]
+
+
+# Returns the updated username and streak, None if the user doesn't exist
+async def update_after_activity_creation(user_id: str, points_gained: int) -> dict[str, Any] | None:
+    result = await session.users_collection().find_one_and_update(
         {'_id': ObjectId(user_id)},
-        {
-            '$set': {
-                'streak': new_streak,
-                'last_time_on_streak': new_last_time_on_streak,
-                'points': new_points
-            },
-            '$push': {'activities': activity_id}
-        }
-    ).modified_count
-    return modified_count == 1
+        activity_creation_update(points_gained),
+        projection={'username': 1, 'streak': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    forget_users(user_id)
+    return result
+
+
+# Undoes the points and activity_count of update_after_activity_creation when the activity couldn't be stored.
+# The streak stays, last_time_on_streak was overwritten and the previous value is gone.
+async def revert_activity_creation(user_id: str, points_gained: int) -> None:
+    await session.users_collection().update_one(
+        {'_id': ObjectId(user_id)},
+        {'$inc': {'points': -points_gained, 'activity_count': -1}}
+    )
+    forget_users(user_id)
 
 
-def increment_user_points(user_id: str, amount: int) -> bool:
-    modified_count = session.users_collection().update_one(
+async def increment_user_points(user_id: str, amount: int) -> bool:
+    modified_count = (await session.users_collection().update_one(
         {'_id': ObjectId(user_id)},
         {'$inc': {'points': amount}}
-    ).modified_count
+    )).modified_count
+    forget_users(user_id)
     return modified_count == 1
 
 
 # Functions related to friendship
-def is_user_friend(my_id: str, friend_id: str) -> bool:
-    result = session.users_collection().find_one({
-        '_id': ObjectId(my_id),
-        'friends': ObjectId(friend_id)
-    })
-    return bool(result)
+async def is_user_friend(my_id: str, friend_id: str) -> bool:
+    return ObjectId(friend_id) in await get_friend_set(my_id)
 
 
-def is_request_outgoing(my_id: str, friend_id: str) -> bool:
-    result = session.users_collection().find_one({
-        '_id': ObjectId(my_id),
-        'outgoing_requests': {'$elemMatch': {'user_id': ObjectId(friend_id)}}
-    })
+async def get_friend_set(user_id: str) -> frozenset[ObjectId]:
+    friends = friend_cache.get(user_id)
+    if friends is not None:
+        return friends
 
-    return bool(result)
+    generation = friend_cache.generation()
+    friends = frozenset(await get_friends(user_id))
+    friend_cache.put(user_id, friends, generation)
+    return friends
 
 
-def is_request_incoming(my_id: str, friend_id: str) -> bool:
-    return is_request_outgoing(friend_id, my_id)
+async def is_request_outgoing(my_id: str, friend_id: str) -> bool:
+    result = await find_by_id('users', ObjectId(my_id), ['outgoing_requests'])
+    if result is None:
+        return False
 
+    friend_id = ObjectId(friend_id)
+    return any(request['user_id'] == friend_id for request in result.get('outgoing_requests', []))
 
-def get_friends(_id: str) -> list[ObjectId]:
-    result = session.users_collection().find_one(
-        {'_id': ObjectId(_id)},
-        {'_id': 0, 'friends': 1}
-    )
+
+async def is_request_incoming(my_id: str, friend_id: str) -> bool:
+    return await is_request_outgoing(friend_id, my_id)
+
+
+async def get_friends(_id: str) -> list[ObjectId]:
+    result = await find_by_id('users', ObjectId(_id), ['friends'])
     if result is None:
         return []
     friends = result['friends'] if 'friends' in result else []
     return friends
 
 
-def get_incoming_requests(_id: str) -> list[FriendshipRequest]:
-    result = session.users_collection().find_one(  # it is find_one because we're looking for only one document (1 user)
+async def get_incoming_requests(_id: str) -> list[FriendshipRequest]:
+    result = await session.users_collection().find_one(  # it is find_one because we're looking for only one document (1 user)
         {'_id': ObjectId(_id)},
         {'incoming_requests': 1}
     )
@@ -202,8 +310,8 @@ def get_incoming_requests(_id: str) -> list[FriendshipRequest]:
     return requests
 
 
-def get_outgoing_requests(_id: str) -> list[FriendshipRequest]:
-    result = session.users_collection().find_one(
+async def get_outgoing_requests(_id: str) -> list[FriendshipRequest]:
+    result = await session.users_collection().find_one(
         {'_id': ObjectId(_id)},
         {'outgoing_requests': 1}
     )
@@ -214,7 +322,7 @@ def get_outgoing_requests(_id: str) -> list[FriendshipRequest]:
     return requests
 
 
-def send_request(my_id: str, my_username: str, friend_id: str, friend_username: str) -> bool:
+async def send_request(my_id: str, my_username: str, friend_id: str, friend_username: str) -> bool:
 
     request_to_friend = FriendshipRequest(user_id=friend_id, username=friend_username)
     request_from_me = FriendshipRequest(user_id=my_id, username=my_username)
@@ -225,7 +333,7 @@ def send_request(my_id: str, my_username: str, friend_id: str, friend_username:
         'username': request_to_friend.username,
         'sent_at': request_to_friend.sent_at
     }}}
-    modified_count = session.users_collection().update_one(query, update).modified_count
+    modified_count = (await session.users_collection().update_one(query, update)).modified_count
 
     query = {'_id': ObjectId(friend_id)}  # add request to friend's incoming_requests
     update = {'$push': {'incoming_requests': {
@@ -233,115 +341,168 @@ def send_request(my_id: str, my_username: str, friend_id: str, friend_username:
         'username': request_from_me.username,
         'sent_at': request_from_me.sent_at
     }}}
-    modified_count += session.users_collection().update_one(query, update).modified_count
+    modified_count += (await session.users_collection().update_one(query, update)).modified_count
 
+    forget_users(my_id, friend_id)
     return modified_count == 2
 
 
-def cancel_request(my_id: str, friend_id: str) -> bool:
+async def cancel_request(my_id: str, friend_id: str) -> bool:
 
     my_id = ObjectId(my_id)
     friend_id = ObjectId(friend_id)
 
     query = {'_id': my_id}  # delete request instance for me
     update = {'$pull': {'outgoing_requests': {'user_id': friend_id}}}
-    modified_count = session.users_collection().update_one(query, update).modified_count
+    modified_count = (await session.users_collection().update_one(query, update)).modified_count
 
     query = {'_id': friend_id}  # delete request instance for friend
     update = {'$pull': {'incoming_requests': {'user_id': my_id}}}
-    modified_count += session.users_collection().update_one(query, update).modified_count
+    modified_count += (await session.users_collection().update_one(query, update)).modified_count
 
+    forget_users(my_id, friend_id)
     return modified_count == 2
 
 
 # opposite operation to cancel_request - delete your incoming request, outgoing_request in friend
-def decline_request(my_id: str, friend_id: str) -> bool:
-    return cancel_request(friend_id, my_id)
+async def decline_request(my_id: str, friend_id: str) -> bool:
+    return await cancel_request(friend_id, my_id)
 
 
-def accept_request(my_id: str, friend_id: str) -> bool:
+async def accept_request(my_id: str, friend_id: str) -> bool:
 
     my_id = ObjectId(my_id)
     friend_id = ObjectId(friend_id)
 
-    query = {"_id": my_id}  # add friend to my instance
-    update = {"$addToSet": {"friends": friend_id}}
-    modified_count = session.users_collection().update_one(query, update).modified_count
+    # friend_count changes in the same update as friends, and only if the array actually changed
+    query = {"_id": my_id, "friends": {"$ne": friend_id}}  # add friend to my instance
+    update = {"$push": {"friends": friend_id}, "$inc": {"friend_count": 1}}
+    modified_count = (await session.users_collection().update_one(query, update)).modified_count
 
-    query = {"_id": friend_id}  # add me to friend's instance
-    update = {"$addToSet": {"friends": my_id}}
-    modified_count += session.users_collection().update_one(query, update).modified_count
+    query = {"_id": friend_id, "friends": {"$ne": my_id}}  # add me to friend's instance
+    update = {"$push": {"friends": my_id}, "$inc": {"friend_count": 1}}
+    modified_count += (await session.users_collection().update_one(query, update)).modified_count
+
+    forget_users(my_id, friend_id)
+    friend_cache.invalidate(str(my_id), str(friend_id))
+
+    if settings.feed_timelines_enabled and modified_count:
+        await timeline_model.backfill_friendship(my_id, friend_id)
 
     return modified_count == 2
 
 
-def delete_friend(my_id: str, friend_id: str) -> int:
+async def delete_friend(my_id: str, friend_id: str) -> int:
 
     my_id = ObjectId(my_id)
     friend_id = ObjectId(friend_id)
 
-    query = {"_id": my_id}  # delete friend instance for me
-    update = {"$pull": {"friends": friend_id}}
-    matched_count = session.users_collection().update_one(query, update).matched_count
+    query = {"_id": my_id, "friends": friend_id}  # delete friend instance for me
+    update = {"$pull": {"friends": friend_id}, "$inc": {"friend_count": -1}}
+    matched_count = (await session.users_collection().update_one(query, update)).matched_count
 
-    query = {"_id": friend_id}  # delete request instance for friend
-    update = {"$pull": {"friends": my_id}}
-    matched_count += session.users_collection().update_one(query, update).matched_count
+    query = {"_id": friend_id, "friends": my_id}  # delete request instance for friend
+    update = {"$pull": {"friends": my_id}, "$inc": {"friend_count": -1}}
+    matched_count += (await session.users_collection().update_one(query, update)).matched_count
 
-    return matched_count
+    forget_users(my_id, friend_id)
+    friend_cache.invalidate(str(my_id), str(friend_id))
 
+    if settings.feed_timelines_enabled:
+        await timeline_model.remove_friend_items(my_id, friend_id)
+
+    return matched_count
 
-def __get_n_best_recommendations(friends, amount) -> list[FriendCloseness]:
-    closest_friends = []
-    for closeness in friends:
-        if len(closest_friends) < amount:
-            heapq.heappush(closest_friends, closeness)
-        else:
-            heapq.heappushpop(closest_friends, closeness)
-    return closest_friends
 
+def rank_recommendations(
+        my_id: Hashable,
+        my_friends: Iterable[Hashable],
+        friends_of_friends: Iterable[Iterable[Hashable]],
+        amount: int,
+        tie_break: Callable[[Hashable], Any] = str
+) -> list[Hashable]:
+    # friends_of_friends holds the friend list of every friend of mine, so a candidate's count is the mutual friends
+    mutual_friends = Counter()
+    for friend_friends in friends_of_friends:
+        mutual_friends.update(friend_friends)
 
-def get_friend_recommendation_profiles(my_id: str, amount: int) -> list[PublicUserModel]:
-    my_friends = list(map(str, get_friends(my_id)))
-    all_recommendations = set()
+    mutual_friends.pop(my_id, None)
     for friend in my_friends:
-        friend_friends = get_friends(friend)
-        all_recommendations |= set(map(lambda x: FriendCloseness(str(x)), friend_friends))
+        mutual_friends.pop(friend, None)
 
-    to_discard = my_friends
-    to_discard.append(my_id)
+    # ties are broken by id so the ranking doesn't depend on the order the friend lists were read in,
+    # callers ranking something else than ObjectIds pass a tie_break that orders them like their ObjectId strings
+    top_n = heapq.nlargest(amount, mutual_friends.items(), key=lambda item: (item[1], tie_break(item[0])))
+    return [candidate for candidate, _ in top_n]
 
-    to_discard_set = set(map(FriendCloseness, to_discard))
-    resulting_recommendations = all_recommendations - to_discard_set
 
-    top_n = sorted(__get_n_best_recommendations(resulting_recommendations, amount), reverse=True)
+async def get_public_users(user_ids: list[ObjectId]) -> list[PublicUserModel]:
+    results = await find_by_ids('users', user_ids, PUBLIC_USER_FIELDS)
 
-    id_list = [recommendation.id for recommendation in top_n]
+    by_id = {result['_id']: result for result in results}
+    return [from_document(PublicUserModel, by_id[_id]) for _id in user_ids if _id in by_id]
 
-    profiles = [get_public_user(friend_id) for friend_id in id_list]
-    return profiles
+
+async def get_friend_recommendation_profiles(my_id: str, amount: int) -> list[PublicUserModel]:
+    my_friends = await get_friends(my_id)
+
+    precomputed = await recommendation_model.get_recommended_ids(my_id)
+    if precomputed is not None:
+        # people that became my friends after the job ran are skipped
+        friend_set = set(my_friends)
+        return await get_public_users([_id for _id in precomputed if _id not in friend_set][:amount])
+
+    if not my_friends:
+        return []
+
+    results = await session.users_collection().find(
+        {'_id': {'$in': my_friends}}, {'_id': 0, 'friends': 1}
+    ).to_list()
+
+    recommended_ids = rank_recommendations(
+        ObjectId(my_id), my_friends, (result.get('friends', []) for result in results), amount
+    )
+    return await get_public_users(recommended_ids)
 
 
 # Functions related to user profile
 
-def set_about_me(user_id: str, about_me: str) -> bool:
-    modified_count = session.users_collection().update_one(
+async def set_about_me(user_id: str, about_me: str) -> bool:
+    modified_count = (await session.users_collection().update_one(
         {'_id': ObjectId(user_id)},
         {'$set': {'about_me': about_me}}
-    ).modified_count
+    )).modified_count
+    forget_users(user_id)
     return modified_count == 1
 
 
-def set_profile_pic(user_id: str, profile_pic: str) -> bool:
-    modified_count = session.users_collection().update_one(
+# Returns the previous profile picture ('' if there was none) so its reference can be released, None if there is no
+# such user
+async def set_profile_pic(user_id: str, profile_pic: str) -> str | None:
+    result = await session.users_collection().find_one_and_update(
         {'_id': ObjectId(user_id)},
-        {'$set': {'profile_pic': profile_pic}}
-    ).modified_count
+        {'$set': {'profile_pic': profile_pic, 'profile_pic_variants': {}}},
+        projection={'profile_pic': 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    forget_users(user_id)
+    if result is None:
+        return None
+    return result.get('profile_pic', '')
+
+
+# Only recorded while profile_pic is still the picture the variants were generated from
+async def set_profile_pic_variants(user_id: str, profile_pic: str, variants: dict[int, str]) -> bool:
+    modified_count = (await session.users_collection().update_one(
+        {'_id': ObjectId(user_id), 'profile_pic': profile_pic},
+        {'$set': {'profile_pic_variants': {str(width): filename for width, filename in variants.items()}}}
+    )).modified_count
+    forget_users(user_id)
     return modified_count == 1
 
 
-def get_profile_pic(user_id: str) -> str | None:
-    results = session.users_collection().find_one({'_id': ObjectId(user_id)}, {'profile_pic': 1})
+async def get_profile_pic(user_id: str) -> str | None:
+    results = await find_by_id('users', ObjectId(user_id), ['profile_pic'])
     if results and 'profile_pic' in results:
         return results['profile_pic']
     return None
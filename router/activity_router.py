@@ -1,23 +1,33 @@
 from typing import Annotated
-from datetime import datetime, timezone, timedelta
 
-from fastapi import Depends, APIRouter, Form, UploadFile, HTTPException, BackgroundTasks
+from fastapi import Depends, APIRouter, Form, Query, UploadFile, HTTPException, BackgroundTasks
+from pymongo.errors import PyMongoError
 
 from controller.auth_controller import TokenData, parse_token
 import model.user_model as user_model
 import model.activity_model as activity_model
-from model.request_model import ObjectIdStr
+from model.request_model import ObjectIdStr, ActivityIdsBody, ImageWidth
+from model.pagination_model import ActivityIdPage, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 import utils.file_handler as file_handler
+import utils.image_processor as image_processor
+from utils.json_response import FastJSONResponse
 from config.settings import settings
 
 
 activity_router = APIRouter()
 
 
+# Runs as a background task, after the upload response was sent
+async def process_images(activity_id: str, filenames: list[str]):
+    variants = await image_processor.create_variants(filenames)
+    await activity_model.add_image_variants(activity_id, variants)
+
+
 @activity_router.post('/', status_code=201)
 async def create_activity(
         token_data: Annotated[TokenData, Depends(parse_token)],
+        background_tasks: BackgroundTasks,
         activity_type: Annotated[activity_model.ActivityType, Form()],
         title: Annotated[str, Form()],
         caption: Annotated[str, Form()] = None,
@@ -26,84 +36,107 @@ async def create_activity(
     if images and len(images) > settings.max_images_per_activity:
         raise HTTPException(400, f'Too many files uploaded: {len(images)}. Max {settings.max_images_per_activity}.')
 
-    user = user_model.get_user_by_id(token_data.user_id)
-
-    new_last_time_on_streak = datetime.now(timezone.utc)
-
-    if user.last_time_on_streak is None:
-        new_streak = 1
-    elif datetime.now(timezone.utc) - user.last_time_on_streak.replace(tzinfo=timezone.utc) < timedelta(hours=48):
-        new_streak = user.streak + 1
-    else:
-        new_streak = 1
-
-    points_gained = activity_model.activity_points[activity_type] or 0
-    new_points = user.points + points_gained
-
-    image_filenames = []
-    if images:
-        for uploaded_file in images:
-            filename = file_handler.handle_file_upload(uploaded_file)
-            image_filenames.append(filename)
-
-    new_activity = activity_model.NewActivityModel(
-        user_id=token_data.user_id,
-        username=user.username,
-        activity_type=activity_type,
-        title=title,
-        caption=caption,
-        streak_snapshot=new_streak,
-        points_gained=points_gained,
-        images=image_filenames
-    )
-
-    activity_id = activity_model.create_activity(new_activity)
+    # all images are streamed to disk concurrently and validated before anything is written to the database,
+    # every stored image holds a reference that is released if the activity isn't created
+    image_filenames = await file_handler.store_uploaded_files(images) if images else []
+
+    try:
+        points_gained = activity_model.activity_points[activity_type] or 0
+
+        # streak and points are computed and written by the database in one atomic update
+        user = await user_model.update_after_activity_creation(token_data.user_id, points_gained)
+        if user is None:
+            raise HTTPException(404)
+
+        try:
+            new_activity = activity_model.NewActivityModel(
+                user_id=token_data.user_id,
+                username=user['username'],
+                activity_type=activity_type,
+                title=title,
+                caption=caption,
+                streak_snapshot=user['streak'],
+                points_gained=points_gained,
+                images=image_filenames
+            )
+            activity_id = await activity_model.create_activity(new_activity)
+        except BaseException:
+            await user_model.revert_activity_creation(token_data.user_id, points_gained)
+            raise
+    except BaseException:
+        await file_handler.release_uploaded_files(image_filenames)
+        raise
+
+    # The activity and its image references are stored. A failed fan-out only leaves it out of the friends'
+    # timelines until `manage.py rebuild-timelines`, answering with an error would make the client create it again.
+    try:
+        await activity_model.publish_activity(new_activity, activity_id)
+    except PyMongoError as e:
+        print(f'Could not add activity {activity_id} to the timelines: {e!r}')
+
+    if image_filenames:
+        background_tasks.add_task(process_images, str(activity_id), image_filenames)
+
+
+@activity_router.get('/feed', response_model=ActivityIdPage | activity_model.ActivityPage)
+async def get_feed(
+        token_data: Annotated[TokenData, Depends(parse_token)],
+        cursor: str | None = None,
+        limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+        hydrate: bool = False,
+        image_width: ImageWidth = None
+) -> FastJSONResponse:
+    try:
+        page = await activity_model.get_feed(token_data.user_id, cursor, limit)
+    except ValueError:
+        raise HTTPException(400, 'Invalid cursor')
 
-    user_model.update_after_activity_creation(
-        user_id=token_data.user_id,
-        new_points=new_points,
-        new_streak=new_streak,
-        new_last_time_on_streak=new_last_time_on_streak,
-        activity_id=activity_id
-    )
-    if images:
-        for uploaded_file, filename in zip(images, image_filenames):
-            await file_handler.save_uploaded_file(uploaded_file, filename)
+    if not hydrate:
+        return FastJSONResponse(page)
 
+    activities = await activity_model.get_visible_activities(token_data.user_id, page.items)
+    return FastJSONResponse(activity_model.ActivityPage.model_construct(
+        items=[activity.with_image_width(image_width) for activity in activities], next_cursor=page.next_cursor
+    ))
 
-@activity_router.get('/feed')
-def get_feed(
-        token_data: Annotated[TokenData, Depends(parse_token)]
-) -> list[str]:
-    activity_ids = activity_model.get_feed(token_data.user_id)
 
-    return activity_ids
+@activity_router.post('/batch', response_model=list[activity_model.ActivityModel])
+async def get_activity_batch(
+        body: ActivityIdsBody, token_data: Annotated[TokenData, Depends(parse_token)], image_width: ImageWidth = None
+) -> FastJSONResponse:
+    activities = await activity_model.get_visible_activities(token_data.user_id, body.activity_ids)
+    return FastJSONResponse([activity.with_image_width(image_width) for activity in activities])
 
 
 @activity_router.get('/activities/{user_id}')
-def get_activities(
-        user_id: ObjectIdStr, token_data: Annotated[TokenData, Depends(parse_token)]
-) -> list[str]:
+async def get_activities(
+        user_id: ObjectIdStr,
+        token_data: Annotated[TokenData, Depends(parse_token)],
+        cursor: str | None = None,
+        limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE
+) -> ActivityIdPage:
 
-    if user_id != token_data.user_id and not user_model.is_user_friend(token_data.user_id, user_id):
+    if user_id != token_data.user_id and not await user_model.is_user_friend(token_data.user_id, user_id):
         raise HTTPException(403)
 
-    activity_ids = activity_model.get_user_activities(user_id)
-    return activity_ids
+    try:
+        return await activity_model.get_user_activities(user_id, cursor, limit)
+    except ValueError:
+        raise HTTPException(400, 'Invalid cursor')
 
 
-@activity_router.get('/{activity_id}')
-def get_activity(
-        activity_id: ObjectIdStr, token_data: Annotated[TokenData, Depends(parse_token)]
-) -> activity_model.ActivityModel:
-    activity = activity_model.get_activity_by_id(activity_id)
+@activity_router.get('/{activity_id}', response_model=activity_model.ActivityModel)
+async def get_activity(
+        activity_id: ObjectIdStr, token_data: Annotated[TokenData, Depends(parse_token)], image_width: ImageWidth = None
+) -> FastJSONResponse:
+    activity = await activity_model.get_activity_by_id(activity_id)
     if not activity:
         raise HTTPException(404)
 
     activity_owner = str(activity.user_id)
-    if activity_owner != token_data.user_id and not user_model.is_user_friend(token_data.user_id, activity_owner):
+    if activity_owner != token_data.user_id and not await user_model.is_user_friend(token_data.user_id, activity_owner):
         raise HTTPException(403)
-    return activity
+    return FastJSONResponse(activity.with_image_width(image_width))
 
 
 @activity_router.patch('/{activity_id}')
@@ -116,7 +149,7 @@ async def update_activity(
         new_images: list[UploadFile] | None = None,
         images_to_delete: list[str] | None = None
 ):
-    activity = activity_model.get_activity_by_id(activity_id)
+    activity = await activity_model.get_activity_by_id(activity_id)
     if not activity:
         raise HTTPException(404)
     if str(activity.user_id) != token_data.user_id:
@@ -134,27 +167,38 @@ async def update_activity(
         raise HTTPException(400, f'Exceeeded the maximum number of images per activity '
                                  f'({settings.max_images_per_activity}).')
 
-    new_filenames = []
-    for new_image in new_images:
-        filename = file_handler.handle_file_upload(new_image)
-        new_filenames.append(filename)
+    new_filenames = await file_handler.store_uploaded_files(new_images)
 
     title = title or activity.title
     caption = caption or activity.caption
-    images = list(set(activity.images).union(set(new_filenames)).difference(set(images_to_delete)))
+    # every occurrence of a filename holds a reference, so duplicates are kept
+    removed_images = [image for image in activity.images if image in images_to_delete]
+    images = [image for image in activity.images if image not in images_to_delete] + new_filenames
 
-    activity_model.update_activity(activity_id, title, caption, images)
+    try:
+        updated = await activity_model.update_activity(activity_id, title, caption, images)
+    except BaseException:
+        await file_handler.release_uploaded_files(new_filenames)
+        raise
 
-    for new_image, new_filename in zip(new_images, new_filenames):
-        await file_handler.save_uploaded_file(new_image, new_filename)
+    # not modified: the activity was deleted meanwhile (which released its images) or nothing changed
+    if not updated:
+        await file_handler.release_uploaded_files(new_filenames)
+        return
 
-    for filename in images_to_delete:
-        background_taks.add_task(file_handler.delete_uploaded_file, filename)
+    if removed_images:
+        background_taks.add_task(file_handler.release_uploaded_files, removed_images)
+    if new_filenames:
+        background_taks.add_task(process_images, activity_id, new_filenames)
 
 
 @activity_router.delete('/{activity_id}')
-def delete_activity(activity_id: ObjectIdStr, token_data: Annotated[TokenData, Depends(parse_token)]):
-    activity = activity_model.get_activity_by_id(activity_id)
+async def delete_activity(
+        activity_id: ObjectIdStr,
+        token_data: Annotated[TokenData, Depends(parse_token)],
+        background_tasks: BackgroundTasks
+):
+    activity = await activity_model.get_activity_by_id(activity_id)
     if not activity:
         raise HTTPException(404)
 
@@ -162,5 +206,6 @@ def delete_activity(activity_id: ObjectIdStr, token_data: Annotated[TokenData, D
         raise HTTPException(403)
 
     activity_points = activity.points_gained
-    user_model.increment_user_points(token_data.user_id, -activity_points)
-    activity_model.delete_activity(activity_id, token_data.user_id)
+    await user_model.increment_user_points(token_data.user_id, -activity_points)
+    if await activity_model.delete_activity(activity_id, token_data.user_id) and activity.images:
+        background_tasks.add_task(file_handler.release_uploaded_files, activity.images)
@@ -0,0 +1,37 @@
+from typing import Annotated
+
+from fastapi import Depends, APIRouter, Query, HTTPException
+
+from controller.auth_controller import TokenData, parse_admin_token
+import db.slow_queries as slow_queries
+
+
+admin_router = APIRouter()
+
+
+def get_slow_query_recorder() -> slow_queries.SlowQueryRecorder:
+    if slow_queries.slow_query_recorder is None:
+        raise HTTPException(404, 'The slow query recorder is disabled, set SLOW_QUERY_ENABLED=true')
+    return slow_queries.slow_query_recorder
+
+
+# Newest first, see db/slow_queries.py
+@admin_router.get('/slow-queries')
+async def get_slow_queries(
+        _token_data: Annotated[TokenData, Depends(parse_admin_token)],
+        limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+        flagged: bool = False
+) -> dict:
+    recorder = get_slow_query_recorder()
+    entries = list(reversed(recorder.entries))
+    if flagged:
+        entries = [
+            entry for entry in entries
+            if entry['plan'] is not None and (entry['plan']['collscan'] or entry['plan']['in_memory_sort'])
+        ]
+    return {**recorder.stats(), 'entries': entries[:limit]}
+
+
+@admin_router.delete('/slow-queries', status_code=204)
+async def clear_slow_queries(_token_data: Annotated[TokenData, Depends(parse_admin_token)]) -> None:
+    get_slow_query_recorder().entries.clear()
@@ -3,16 +3,22 @@ from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated
 
 import controller.auth_controller as auth_controller
+from model.request_model import RefreshTokenBody
 
 auth_router = APIRouter()
 
 
 @auth_router.post('/token')
-def create_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> auth_controller.Token:
-    return auth_controller.create_token(form_data)
+async def create_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> auth_controller.Token:
+    return await auth_controller.create_token(form_data)
+
+
+@auth_router.post('/token/refresh')
+async def refresh_token(body: RefreshTokenBody) -> auth_controller.Token:
+    return await auth_controller.refresh_tokens(body.refresh_token)
 
 
 @auth_router.post('/signup', status_code=201)
-def signup_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> None:
-    if not auth_controller.create_account(form_data):
+async def signup_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> None:
+    if not await auth_controller.create_account(form_data):
         raise HTTPException(400)
@@ -0,0 +1,31 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Request
+from pymongo.errors import PyMongoError
+
+from db.session import session
+
+
+READY_TIMEOUT_SECONDS = 2
+
+health_router = APIRouter()
+
+
+# Liveness: the process answers. The database isn't checked, an outage of it shouldn't get every worker restarted.
+@health_router.get('/health')
+async def get_health() -> dict:
+    return {'status': 'ok'}
+
+
+# Readiness: the startup work (see lifespan in main.py) is done and the database answers
+@health_router.get('/ready')
+async def get_ready(request: Request) -> dict:
+    startup = getattr(request.app.state, 'startup', None)
+    if startup is None or not startup.done():
+        raise HTTPException(503, 'Starting')
+
+    try:
+        await asyncio.wait_for(session.ping(), READY_TIMEOUT_SECONDS)
+    except (asyncio.TimeoutError, PyMongoError):
+        raise HTTPException(503, 'Database unreachable')
+    return {'status': 'ready'}
@@ -0,0 +1,54 @@
+from anyio import to_thread
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import Response
+
+from utils.password_hasher import hash_pool
+from utils.file_handler import copy_stats
+from utils.image_processor import image_pool, variants_enabled
+from model.friend_cache import friend_cache
+from utils.metrics import metrics_enabled, render, add_collector, StatsCollector
+
+
+metrics_router = APIRouter()
+
+
+# Starlette runs the blocking storage calls (saves, deletes, discarded temp files) on anyio's default thread
+# limiter. Uploads are copied on file_handler's own copy threads, reported as upload_copy.
+def threadpool_stats() -> dict:
+    statistics = to_thread.current_default_thread_limiter().statistics()
+    return {
+        'threads': statistics.total_tokens,
+        'busy': statistics.borrowed_tokens,
+        'waiting': statistics.tasks_waiting,
+    }
+
+
+add_collector(StatsCollector('threadpool', threadpool_stats))
+add_collector(StatsCollector('upload_copy', copy_stats))
+add_collector(StatsCollector('hash_pool', hash_pool.stats, counters=('completed', 'failed', 'rejected')))
+add_collector(StatsCollector('image_pool', image_pool.stats, counters=('completed', 'failed', 'rejected')))
+add_collector(StatsCollector('friend_cache', friend_cache.stats, counters=('hits', 'misses', 'evictions')))
+
+
+# Prometheus text format. Rendered on the event loop, the threadpool statistics can only be read from there.
+@metrics_router.get('')
+async def get_metrics() -> Response:
+    if not metrics_enabled():
+        raise HTTPException(404, 'Metrics are disabled or prometheus_client is not installed')
+    content, media_type = render()
+    return Response(content, media_type=media_type)
+
+
+@metrics_router.get('/hash-pool')
+async def get_hash_pool_metrics() -> dict:
+    return hash_pool.stats()
+
+
+@metrics_router.get('/friend-cache')
+async def get_friend_cache_metrics() -> dict:
+    return friend_cache.stats()
+
+
+@metrics_router.get('/image-pool')
+async def get_image_pool_metrics() -> dict:
+    return {'enabled': variants_enabled(), **image_pool.stats()}
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from utils.storage import get_storage, is_valid_filename
+
+
+static_router = APIRouter()
+
+
+# Uploaded images, wherever the storage backend keeps them. Files that were stored flat before the sharded layout
+# are still found by the local backend.
+@static_router.api_route('/{filename}', methods=['GET', 'HEAD'])
+async def get_static_file(filename: str) -> Response:
+    if not is_valid_filename(filename):
+        raise HTTPException(404)
+
+    response = await run_in_threadpool(get_storage().response, filename)
+    if response is None:
+        raise HTTPException(404)
+    return response
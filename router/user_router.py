@@ -1,95 +1,127 @@
+import asyncio
 from typing import Annotated
 
-from fastapi import Depends, APIRouter, UploadFile, HTTPException, BackgroundTasks
+from fastapi import Depends, APIRouter, Path, Query, UploadFile, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
 
-from model.request_model import UserIdBody, AboutMeBody
+from model.request_model import UserIdBody, AboutMeBody, ImageWidth
 from controller.auth_controller import TokenData, parse_token
 import model.user_model as user_model
 from pydantic import Field
 
 import utils.file_handler as file_handler
+import utils.image_processor as image_processor
+from utils.json_response import FastJSONResponse
 
 
 user_router = APIRouter()
 
 
+# Runs as a background task, after the upload response was sent
+async def process_profile_pic(user_id: str, filename: str):
+    variants = (await image_processor.create_variants([filename])).get(filename)
+    if variants:
+        await user_model.set_profile_pic_variants(user_id, filename, variants)
+
+
 @user_router.post('/invitation/send', status_code=201)
-def invite_user(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
+async def invite_user(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
 
     if token_data.user_id == body.user_id:
         raise HTTPException(400, 'You cannot send an invitation to yourself')
-    if user_model.is_request_outgoing(token_data.user_id, body.user_id):
+
+    # issued together, so the request loader reads both users with a single query
+    user, friend, outgoing, incoming, already_friends = await asyncio.gather(
+        user_model.get_public_user(token_data.user_id),
+        user_model.get_public_user(body.user_id),
+        user_model.is_request_outgoing(token_data.user_id, body.user_id),
+        user_model.is_request_incoming(token_data.user_id, body.user_id),
+        user_model.is_user_friend(token_data.user_id, body.user_id)
+    )
+
+    if outgoing:
         raise HTTPException(400, 'Invitation request already sent to that person')
-    if user_model.is_request_incoming(token_data.user_id, body.user_id):
+    if incoming:
         raise HTTPException(400, 'Invitation request already incoming from that person')
-    if user_model.is_user_friend(token_data.user_id, body.user_id):
+    if already_friends:
         raise HTTPException(400, 'You are already friends')
 
-    user = user_model.get_user_by_id(token_data.user_id)
-    friend = user_model.get_user_by_id(body.user_id)
-
     if not user or not friend:
         raise HTTPException(404)
 
-    if not user_model.send_request(token_data.user_id, user.username, body.user_id, friend.username):
+    if not await user_model.send_request(token_data.user_id, user.username, body.user_id, friend.username):
         raise HTTPException(400)
 
 
 @user_router.delete('/invitation/cancel')
-def cancel_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
-    if not user_model.cancel_request(token_data.user_id, body.user_id):
+async def cancel_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
+    if not await user_model.cancel_request(token_data.user_id, body.user_id):
         raise HTTPException(400)  # 'No invitation to cancel or something went wrong'
 
 
 @user_router.post('/invitation/accept', status_code=201)
-def accept_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
+async def accept_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
 
-    if not user_model.is_request_incoming(token_data.user_id, body.user_id):
+    if not await user_model.is_request_incoming(token_data.user_id, body.user_id):
         raise HTTPException(400, 'No invitation to accept')
 
-    deletion_success = user_model.decline_request(token_data.user_id, body.user_id)
+    deletion_success = await user_model.decline_request(token_data.user_id, body.user_id)
 
-    if not deletion_success or not user_model.accept_request(token_data.user_id, body.user_id):
+    if not deletion_success or not await user_model.accept_request(token_data.user_id, body.user_id):
         raise HTTPException(400)  # 'Already friends or something went wrong'
 
 
 @user_router.delete('/invitation/decline')
-def decline_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
+async def decline_invitation(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
 
-    if not user_model.is_request_incoming(token_data.user_id, body.user_id):
+    if not await user_model.is_request_incoming(token_data.user_id, body.user_id):
         raise HTTPException(400, 'No invitation to decline')
 
-    if not user_model.decline_request(token_data.user_id, body.user_id):
+    if not await user_model.decline_request(token_data.user_id, body.user_id):
         raise HTTPException(400)
 
 
-@user_router.get('/find/{username_search}')
-def find_user_by_username(username_search: str) -> list[user_model.PublicUserModel]:
-    return user_model.search_users(username_search)
+@user_router.get('/find/{username_search}', response_model=user_model.UserSearchPage)
+async def find_user_by_username(
+        username_search: Annotated[str, Path(min_length=1, max_length=64)],
+        cursor: str | None = None,
+        limit: Annotated[int, Query(ge=1, le=user_model.MAX_SEARCH_RESULTS)] = 20,
+        substring: bool = False
+) -> FastJSONResponse:
+    if substring and len(username_search) < user_model.MIN_SUBSTRING_SEARCH_LENGTH:
+        raise HTTPException(400, f'Substring search needs at least {user_model.MIN_SUBSTRING_SEARCH_LENGTH} characters')
+
+    try:
+        return FastJSONResponse(await user_model.search_users(username_search, cursor, limit, substring))
+    except ValueError:
+        raise HTTPException(400, 'Invalid cursor')
 
 
 @user_router.delete('/delete-friend')
-def delete_friend(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
+async def delete_friend(body: UserIdBody, token_data: Annotated[TokenData, Depends(parse_token)]) -> None:
 
-    if not user_model.is_user_friend(token_data.user_id, body.user_id):
+    if not await user_model.is_user_friend(token_data.user_id, body.user_id):
         raise HTTPException(400, 'No friend to delete')
 
-    if not user_model.delete_friend(token_data.user_id, body.user_id):
+    if not await user_model.delete_friend(token_data.user_id, body.user_id):
         raise HTTPException(400)
 
 
-@user_router.get('/my-profile')
-def get_my_profile(token_data: Annotated[TokenData, Depends(parse_token)]) -> user_model.UserModel:
-    user = user_model.get_user_by_id(token_data.user_id)
+# Profiles are read from our own database and returned as they are, without validating them against the response
+# model again (see utils/json_response.py). With thousands of friends that validation was most of the request.
+@user_router.get('/my-profile', response_model=user_model.UserModel)
+async def get_my_profile(
+        token_data: Annotated[TokenData, Depends(parse_token)], image_width: ImageWidth = None
+) -> FastJSONResponse:
+    user = await user_model.get_user_by_id(token_data.user_id)
     if not user:
         raise HTTPException(404)
-    return user
+    return FastJSONResponse(user.with_image_width(image_width))
 
 
 @user_router.post('/about-me')
-def set_about_me_section(body: AboutMeBody, token_data: Annotated[TokenData, Depends(parse_token)]):
-    if not user_model.set_about_me(token_data.user_id, body.about_me):
+async def set_about_me_section(body: AboutMeBody, token_data: Annotated[TokenData, Depends(parse_token)]):
+    if not await user_model.set_about_me(token_data.user_id, body.about_me):
         raise HTTPException(400)
 
 
@@ -98,48 +130,52 @@ async def set_profile_picture(
         file: UploadFile, token_data: Annotated[TokenData, Depends(parse_token)], background_tasks: BackgroundTasks
 ) -> JSONResponse:
 
-    filename = file_handler.handle_file_upload(file)
-    await file_handler.save_uploaded_file(file, filename)
+    filename = await file_handler.store_uploaded_file(file)
 
-    prev_filename = user_model.get_profile_pic(token_data.user_id)
-    if prev_filename:
-        background_tasks.add_task(file_handler.delete_uploaded_file, prev_filename)
+    try:
+        prev_filename = await user_model.set_profile_pic(token_data.user_id, filename)
+    except BaseException:
+        await file_handler.release_uploaded_files([filename])
+        raise
 
-    if not user_model.set_profile_pic(token_data.user_id, filename):
+    if prev_filename is None:
+        await file_handler.release_uploaded_files([filename])
         raise HTTPException(400)
+    if prev_filename:
+        background_tasks.add_task(file_handler.release_uploaded_files, [prev_filename])
+    background_tasks.add_task(process_profile_pic, token_data.user_id, filename)
     return JSONResponse({'uploaded_file': filename})
 
 
 @user_router.delete('/profile-pic')
-def delete_profile_picture(token_data: Annotated[TokenData, Depends(parse_token)], background_tasks: BackgroundTasks):
-    prev_filename = user_model.get_profile_pic(token_data.user_id)
+async def delete_profile_picture(
+        token_data: Annotated[TokenData, Depends(parse_token)], background_tasks: BackgroundTasks
+):
+    prev_filename = await user_model.set_profile_pic(token_data.user_id, '')
     if not prev_filename:
         raise HTTPException(404)
-    background_tasks.add_task(file_handler.delete_uploaded_file, prev_filename)
-
-    if not user_model.set_profile_pic(token_data.user_id, ''):
-        raise HTTPException(400)
+    background_tasks.add_task(file_handler.release_uploaded_files, [prev_filename])
 
 
-@user_router.get('/{user_id}')
-def get_user(
-        user_id: str, token_data: Annotated[TokenData, Depends(parse_token)]
-) -> user_model.PublicUserModel | user_model.PrivateUserModel:
+@user_router.get('/{user_id}', response_model=user_model.PublicUserModel | user_model.PrivateUserModel)
+async def get_user(
+        user_id: str, token_data: Annotated[TokenData, Depends(parse_token)], image_width: ImageWidth = None
+) -> FastJSONResponse:
 
-    if user_model.is_user_friend(token_data.user_id, user_id):
-        user = user_model.get_private_user(user_id)
+    if await user_model.is_user_friend(token_data.user_id, user_id):
+        user = await user_model.get_private_user(user_id)
     else:
-        user = user_model.get_public_user(user_id)
+        user = await user_model.get_public_user(user_id)
 
     if not user:
         raise HTTPException(404)
-    return user
+    return FastJSONResponse(user.with_image_width(image_width))
 
 
-@user_router.get('/friend-recommendations/{amount}')
-def get_friend_recommendations(
+@user_router.get('/friend-recommendations/{amount}', response_model=list[user_model.PublicUserModel])
+async def get_friend_recommendations(
         amount: Annotated[int, Field(le=10)], token_data: Annotated[TokenData, Depends(parse_token)]
-) -> list[user_model.PublicUserModel]:
+) -> FastJSONResponse:
 
-    friend_recommendations = user_model.get_friend_recommendation_profiles(token_data.user_id, amount)
-    return friend_recommendations
+    friend_recommendations = await user_model.get_friend_recommendation_profiles(token_data.user_id, amount)
+    return FastJSONResponse(friend_recommendations)
@@ -1,49 +1,193 @@
 from fastapi import UploadFile, HTTPException
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable
 from uuid import uuid4
+import asyncio
+import hashlib
 import os
+import sys
+import threading
 
 from config.settings import settings
+import model.image_model as image_model
+from utils.storage import get_storage
 
 
-CHUNK_SIZE = 1024 * 1024  # 1 MB
+CHUNK_SIZE = 256 * 1024  # 256 KB
+
+# Niceness of the copy threads, see copy_executor()
+COPY_THREAD_NICENESS = 10
 
 MIME_TYPES = {
     'image/jpeg': 'jpg',
     'image/png': 'png'
 }
 
+# The declared content type comes from the client, the type is decided by the first bytes of the file instead
+MAGIC_NUMBERS = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG\r\n\x1a\n': 'image/png'
+}
+
+
+def sniff_mime_type(head: bytes) -> str | None:
+    for magic_number, mime_type in MAGIC_NUMBERS.items():
+        if head.startswith(magic_number):
+            return mime_type
+    return None
+
+
+# Copies the upload to a temporary file, hashing it on the way. Returns the temporary path and the final filename.
+def _write_temp_file(source: BinaryIO, accepted_mime_types: list[str], max_size: int) -> tuple[str, str]:
+    source.seek(0)
+    chunk = source.read(CHUNK_SIZE)
+    mime_type = sniff_mime_type(chunk)
+    if mime_type not in accepted_mime_types:
+        raise HTTPException(400, {'message': f'Invalid file type. Accepted mime types are: {accepted_mime_types}'})
+
+    digest = hashlib.sha256()
+    temp_path = os.path.join(settings.upload_dir, f'.{uuid4()}.tmp')
+    try:
+        with open(temp_path, 'wb') as output_file:
+            size = 0
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(400, 'File too large')
+                digest.update(chunk)
+                output_file.write(chunk)
+                chunk = source.read(CHUNK_SIZE)
+    except BaseException:
+        _discard_file(temp_path)
+        raise
+
+    return temp_path, f'{digest.hexdigest()}.{MIME_TYPES[mime_type]}'
+
+
+def _discard_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _lower_priority():
+    if sys.platform == 'linux':  # only Linux gives every thread its own niceness
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), COPY_THREAD_NICENESS)
+
+
+_copy_executor: ThreadPoolExecutor | None = None
+_copies_pending = 0  # running or waiting for a copy thread
+
+
+# Unset UPLOAD_COPY_WORKERS: one thread per core, at least 2 so the images of an activity are copied side by side,
+# at most 4 because the copies only need a core each while hashing and more threads only fight the event loop
+# for the GIL
+def copy_workers() -> int:
+    return settings.upload_copy_workers or min(4, max(2, os.cpu_count() or 1))
+
 
-def handle_file_upload(
+# Uploads are copied and hashed by a few dedicated threads, not by one thread per upload: every copy competes with
+# the event loop for the GIL and the CPU. The threads run at a lower priority, so the event loop gets the CPU back
+# as soon as it wakes up.
+def copy_executor() -> ThreadPoolExecutor:
+    global _copy_executor
+    if _copy_executor is None:
+        _copy_executor = ThreadPoolExecutor(
+            copy_workers(), thread_name_prefix='upload-copy', initializer=_lower_priority
+        )
+    return _copy_executor
+
+
+def shutdown_copy_executor():
+    global _copy_executor
+    if _copy_executor is not None:
+        _copy_executor.shutdown()
+        _copy_executor = None
+
+
+def copy_stats() -> dict:
+    workers = copy_workers()
+    return {
+        'workers': workers,
+        'pending': _copies_pending,
+        'queued': max(0, _copies_pending - workers),
+    }
+
+
+async def stage_uploaded_file(
         uploaded_file: UploadFile,
-        accepted_mime_types: set[str] = MIME_TYPES.keys(),
-        max_size_in_mb: int = settings.max_image_size_mb
-) -> str:
-    max_size = max_size_in_mb * 1024 * 1024
+        accepted_mime_types: Iterable[str] = MIME_TYPES.keys(),
+        max_size_in_mb: int | None = None
+) -> tuple[str, str]:
+    max_size = (max_size_in_mb or settings.max_image_size_mb) * 1024 * 1024
 
-    if uploaded_file.size > max_size:
+    if uploaded_file.size is not None and uploaded_file.size > max_size:
         raise HTTPException(400, 'File too large')
 
-    if uploaded_file.content_type not in accepted_mime_types:
-        raise HTTPException(400, {'message': f'Invalid mime type: {uploaded_file.content_type}. '
-                                             f'Accepted mime types are: {accepted_mime_types}'})
+    global _copies_pending
+    _copies_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            copy_executor(), _write_temp_file, uploaded_file.file, list(accepted_mime_types), max_size
+        )
+    finally:
+        _copies_pending -= 1
+
+
+# Copies the upload to storage in a copy thread and returns the stored filename, which holds one reference.
+# The size limit is enforced on the bytes actually copied, not on the declared size.
+# The reference is taken before the file is moved into place, so a concurrent release of the same content
+# can't delete it after we decided to reuse it (see delete_unreferenced_file).
+async def store_uploaded_file(
+        uploaded_file: UploadFile,
+        accepted_mime_types: Iterable[str] = MIME_TYPES.keys(),
+        max_size_in_mb: int | None = None
+) -> str:
+    temp_path, filename = await stage_uploaded_file(uploaded_file, accepted_mime_types, max_size_in_mb)
+
+    try:
+        await image_model.add_references([filename])
+    except BaseException:
+        await run_in_threadpool(_discard_file, temp_path)
+        raise
+
+    try:
+        # replacing an existing copy is harmless, the content is the same
+        await run_in_threadpool(get_storage().save, temp_path, filename)
+    except BaseException:
+        await run_in_threadpool(_discard_file, temp_path)
+        await release_uploaded_files([filename])
+        raise
 
-    uuid = uuid4()
-    filename = f'{uuid}.{MIME_TYPES[uploaded_file.content_type]}'
     return filename
 
 
-async def save_uploaded_file(uploaded_file: UploadFile, filename: str) -> bool:
+# Stores all files concurrently, their copies queue for the copy threads.
+# If any of them is rejected the others are released and the error is raised.
+async def store_uploaded_files(uploaded_files: list[UploadFile]) -> list[str]:
+    results = await asyncio.gather(*map(store_uploaded_file, uploaded_files), return_exceptions=True)
 
-    with open(os.path.join(settings.upload_dir, filename), 'wb') as output_file:
-        while chunk := await uploaded_file.read(CHUNK_SIZE):
-            output_file.write(chunk)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await release_uploaded_files([result for result in results if isinstance(result, str)])
+        raise errors[0]
 
-    return True
+    return results
 
 
 def delete_uploaded_file(filename: str):
-    file_path = os.path.join(settings.upload_dir, filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        return True
-    return False
+    return get_storage().delete(filename)
+
+
+# The files are moved aside before the count is deleted and only removed if the count was still zero. An upload of
+# the same content that took a reference in the meantime puts its own copy in place, and the moved files are put back.
+async def delete_unreferenced_file(filename: str, variants: list[str]):
+    hidden = await run_in_threadpool(get_storage().hide, [filename, *variants])
+    deleted = await image_model.delete_unreferenced(filename)
+    await run_in_threadpool(get_storage().unhide, hidden, deleted)
+
+
+# Drops one reference per filename and deletes the images (and their variants) nobody references anymore
+async def release_uploaded_files(filenames: list[str]):
+    for image in await image_model.remove_references(filenames):
+        await delete_unreferenced_file(image['_id'], list(image.get('variants', {}).values()))
@@ -0,0 +1,106 @@
+# Resized variants of the uploaded images, so clients can load a preview instead of the full resolution original.
+# Decoding and resampling is CPU bound, so variants are generated in a process pool once the upload response
+# has been sent. Pillow is optional, without it no variants are generated and the originals are served for every size.
+import asyncio
+import os
+from uuid import uuid4
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from config.settings import settings
+import model.image_model as image_model
+from utils.process_pool import BoundedProcessPool, PoolFull
+from utils.storage import get_storage, LocalStorage, S3Storage
+
+
+FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP'
+}
+
+
+def variant_filename(filename: str, width: int, webp: bool) -> str:
+    stem, extension = filename.rsplit('.', 1)
+    return f'{stem}_{width}.{"webp" if webp else extension}'
+
+
+# Runs in a worker process. Returns {width: variant filename}, widths not smaller than the original are skipped.
+# The variants are written to temp_dir and then handed over to the storage.
+def generate_variants(
+        storage: LocalStorage | S3Storage, temp_dir: str, filename: str, widths: list[int], webp: bool
+) -> dict[int, str]:
+    variants = {}
+    with storage.open(filename) as source, Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)  # phones store the rotation in EXIF, the resized copies drop it
+
+        for width in sorted(widths):
+            if width >= image.width:
+                break
+
+            name = variant_filename(filename, width, webp)
+            if storage.exists(name):  # same content uploaded before
+                variants[width] = name
+                continue
+
+            resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            temp_path = os.path.join(temp_dir, f'.{name}.{uuid4()}.tmp')  # the same content may be processed twice
+            try:
+                resized.save(temp_path, FORMATS[name.rsplit('.', 1)[1]], quality=80, optimize=True)
+                storage.save(temp_path, name)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            variants[width] = name
+
+    return variants
+
+
+class ImagePoolFull(PoolFull):
+    pass
+
+
+image_pool: BoundedProcessPool = BoundedProcessPool('image_pool', ImagePoolFull)
+
+
+def variants_enabled() -> bool:
+    return Image is not None and bool(settings.image_variant_widths)
+
+
+# {filename: {width: variant filename}} for every image that could be processed. Images are content addressed,
+# so variants are generated once per content and recorded with its reference count. An image that fails
+# (or doesn't fit in the pool) simply has no variants and is served at full resolution.
+async def create_variants(filenames: list[str]) -> dict[str, dict[int, str]]:
+    if not variants_enabled() or not filenames:
+        return {}
+
+    variants = await image_model.get_variants(filenames)
+    missing = [filename for filename in dict.fromkeys(filenames) if filename not in variants]
+
+    storage, widths, webp = get_storage(), settings.image_variant_widths, settings.image_variants_webp
+    results = await asyncio.gather(*(
+        image_pool.run(generate_variants, storage, settings.upload_dir, filename, widths, webp) for filename in missing
+    ), return_exceptions=True)
+
+    created = {}
+    for filename, result in zip(missing, results):
+        if isinstance(result, BaseException):
+            print(f'Could not generate variants of {filename}: {result!r}')
+        else:
+            created[filename] = result
+    await image_model.set_variants(created)
+
+    return {filename: image_variants for filename, image_variants in (variants | created).items() if image_variants}
+
+
+# The smallest variant at least as wide as requested, the original if there is none
+def select_variant(filename: str, variants: dict[int, str], width: int | None) -> str:
+    if width is None or not filename:
+        return filename
+
+    wide_enough = [variant_width for variant_width in variants if variant_width >= width]
+    return variants[min(wide_enough)] if wide_enough else filename
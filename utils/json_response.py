@@ -0,0 +1,25 @@
+# JSON responses encoded straight from models and Mongo documents. Routes return FastJSONResponse(content) instead of
+# the model, so FastAPI doesn't validate the content against the response model again before serializing it;
+# the response model is still declared on the route for the OpenAPI schema.
+# Encoding is done by pydantic-core in Rust. Models serialize their ObjectIds themselves, ObjectIds anywhere else
+# (plain documents) go through _fallback.
+from typing import Any
+
+from bson import ObjectId
+from pydantic_core import to_json
+from starlette.responses import JSONResponse
+
+
+def _fallback(value: Any) -> Any:
+    if type(value) is ObjectId:
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    return to_json(content, by_alias=True, fallback=_fallback)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
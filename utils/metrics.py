@@ -0,0 +1,182 @@
+# Prometheus metrics exported by GET /metrics (prometheus_client is optional, without it nothing is recorded).
+#
+# - MetricsMiddleware times every HTTP request, labelled by the route template (/activity/{activity_id}, not the
+#   actual path, so the number of series stays bounded) and counts the requests in flight
+# - MongoCommandMetrics is a pymongo CommandListener registered on the Session client, timing every command and
+#   counting the documents it returned or wrote, labelled by collection and command name
+# - collectors added with add_collector() are read at scrape time (threadpool, process pools, caches)
+#
+# The hot paths only do a dict lookup and an observe() per request or command, see benchmark/metrics_overhead.py.
+import time
+from typing import Any, Callable, Iterable
+
+from pymongo import monitoring
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+    from prometheus_client import ProcessCollector
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    CollectorRegistry = None
+
+from config.settings import settings
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+DOCUMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000, 10000)
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+def metrics_enabled() -> bool:
+    return CollectorRegistry is not None and settings.metrics_enabled
+
+
+# Created even when METRICS_ENABLED=false, the settings aren't read on import
+if CollectorRegistry is not None:
+    registry = CollectorRegistry()
+    ProcessCollector(registry=registry)
+
+    http_request_duration = Histogram(
+        'http_request_duration_seconds', 'Time to the end of the response body, by route template',
+        ['method', 'route', 'status'], buckets=LATENCY_BUCKETS, registry=registry
+    )
+    http_requests_in_flight = Gauge(
+        'http_requests_in_flight', 'Requests being handled', registry=registry
+    )
+    mongo_command_duration = Histogram(
+        'mongo_command_duration_seconds', 'Mongo command latency reported by the driver',
+        ['collection', 'command'], buckets=MONGO_LATENCY_BUCKETS, registry=registry
+    )
+    mongo_command_documents = Histogram(
+        'mongo_command_documents', 'Documents returned (find, aggregate, getMore) or written by a Mongo command',
+        ['collection', 'command'], buckets=DOCUMENT_BUCKETS, registry=registry
+    )
+    mongo_command_failures = Counter(
+        'mongo_command_failures', 'Mongo commands that failed', ['collection', 'command'], registry=registry
+    )
+else:
+    registry = None
+
+
+def add_collector(collector: Any):
+    if registry is not None:
+        registry.register(collector)
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Pure ASGI, so streaming responses are timed until their last chunk and nothing is buffered
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._enabled: bool | None = None
+        self._children: dict[tuple[str, str, int], Any] = {}
+
+    async def __call__(self, scope, receive, send):
+        if self._enabled is None:
+            self._enabled = metrics_enabled()
+            if settings.metrics_enabled and not self._enabled:
+                print('METRICS_ENABLED=true but prometheus_client is not installed, no metrics are recorded')
+        if scope['type'] != 'http' or not self._enabled:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            http_requests_in_flight.dec()
+
+            # the router stores the matched route in the scope
+            route = scope.get('route')
+            key = (scope['method'], route.path if route is not None else UNMATCHED_ROUTE, status)
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = http_request_duration.labels(*key)
+            child.observe(duration)
+
+
+def _collection(command_name: str, command: dict[str, Any]) -> str:
+    if command_name == 'getMore':
+        return command.get('collection', '')
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ''  # aggregate: 1 and admin commands have no collection
+
+
+def _documents(command_name: str, reply: dict[str, Any]) -> int | None:
+    cursor = reply.get('cursor')
+    if cursor is not None:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+    if command_name == 'findAndModify':
+        return 1 if reply.get('value') is not None else 0
+    if 'n' in reply and command_name in ('insert', 'update', 'delete'):
+        return reply['n']
+    return None
+
+
+# The driver calls the listener synchronously on the event loop for every command, it must stay cheap
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._started: dict[tuple[Any, int], str] = {}
+        self._children: dict[tuple[str, str], tuple[Any, Any]] = {}
+
+    def _labels(self, collection: str, command_name: str) -> tuple[Any, Any]:
+        key = (collection, command_name)
+        children = self._children.get(key)
+        if children is None:
+            children = self._children[key] = (
+                mongo_command_duration.labels(*key), mongo_command_documents.labels(*key)
+            )
+        return children
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        self._started[(event.connection_id, event.request_id)] = _collection(event.command_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._started.pop((event.connection_id, event.request_id), '')
+        duration, documents = self._labels(collection, event.command_name)
+        duration.observe(event.duration_micros / 1_000_000)
+
+        count = _documents(event.command_name, event.reply)
+        if count is not None:
+            documents.observe(count)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._started.pop((event.connection_id, event.request_id), '')
+        self._labels(collection, event.command_name)[0].observe(event.duration_micros / 1_000_000)
+        mongo_command_failures.labels(collection, event.command_name).inc()
+
+
+def mongo_listeners() -> list[monitoring.CommandListener]:
+    return [MongoCommandMetrics()] if metrics_enabled() else []
+
+
+# Collector exporting the numbers of a stats() method (see the other /metrics endpoints) under `prefix`
+class StatsCollector:
+    def __init__(self, prefix: str, stats: Callable[[], dict[str, Any]], counters: Iterable[str] = ()):
+        self._prefix = prefix
+        self._stats = stats
+        self._counters = frozenset(counters)
+
+    def collect(self):
+        for key, value in self._stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{self._prefix}_{key}'
+            if key in self._counters:
+                yield CounterMetricFamily(name, f'{self._prefix} {key}', value=value)
+            else:
+                yield GaugeMetricFamily(name, f'{self._prefix} {key}', value=value)
@@ -0,0 +1,24 @@
+# bcrypt is CPU bound on purpose, so hashing runs in a dedicated process pool instead of the Starlette threadpool.
+# The number of hashes waiting for the pool is bounded (HASH_POOL_MAX_PENDING), above that callers get HashQueueFull
+# straight away so login storms are shed instead of piling up.
+from passlib.context import CryptContext
+
+from utils.process_pool import BoundedProcessPool, PoolFull
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+class HashQueueFull(PoolFull):
+    pass
+
+
+hash_pool: BoundedProcessPool = BoundedProcessPool('hash_pool', HashQueueFull)
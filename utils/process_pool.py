@@ -0,0 +1,101 @@
+# Bounded process pool for the CPU bound work that would hold the GIL on the event loop (password hashing, image
+# variants). At most max_pending calls wait for a worker, above that run() raises PoolFull straight away, so bursts
+# are shed instead of piling up. The size and the bound are the {settings_prefix}_workers and
+# {settings_prefix}_max_pending settings, read when the pool is used.
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+from config.settings import settings
+
+
+class PoolFull(Exception):
+    pass
+
+
+# Workers are started from a clean process instead of forking the app with its event loop, client and threads.
+# forkserver isn't available on Windows.
+def mp_context() -> multiprocessing.context.BaseContext:
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    )
+
+
+class BoundedProcessPool:
+    def __init__(self, settings_prefix: str, full_error: type[PoolFull] = PoolFull):
+        self._settings_prefix = settings_prefix
+        self._full_error = full_error
+        self._executor: ProcessPoolExecutor | None = None
+
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._latencies: deque[float] = deque(maxlen=1000)
+
+    @property
+    def workers(self) -> int:
+        return getattr(settings, f'{self._settings_prefix}_workers')
+
+    @property
+    def max_pending(self) -> int:
+        return getattr(settings, f'{self._settings_prefix}_max_pending')
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=mp_context())
+        return self._executor
+
+    async def _submit(self, fn: Callable[..., Any], *args: Any) -> Any:
+        executor = self._get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # a worker died (OOM killer, segfault) and the executor refuses any further work: replace it
+            if self._executor is executor:
+                self._executor = None
+                executor.shutdown(wait=False)
+            raise
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise self._full_error()
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            try:
+                result = await self._submit(fn, *args)
+            except BrokenProcessPool:
+                result = await self._submit(fn, *args)  # once, on a new executor
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            self._latencies.append(time.perf_counter() - start)
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict[str, Any]:
+        latencies = sorted(self._latencies)
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'latency_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+            'latency_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,275 @@
+# Where the uploaded images live. Files are spread over two levels of subdirectories (keys) named after the first
+# characters of the filename, e.g. ab/cd/abcd1234....jpg, so no directory holds more than a few thousand files.
+# Filenames are hex digests (or uuids for older uploads) so the prefixes are evenly distributed.
+#
+# All methods block, the async code calls them through the threadpool. Uploads are written to a temporary file in
+# settings.upload_dir first and handed over with save().
+#
+# LocalStorage keeps the files under settings.upload_dir and still finds files stored flat in it before
+# `python manage.py migrate-storage` moved them. S3Storage keeps them in an S3 compatible bucket (boto3 is only
+# needed for this backend) and points S3_ENDPOINT_URL to e.g. a local MinIO for testing.
+import io
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import BinaryIO, Iterator
+from uuid import uuid4
+
+from starlette.responses import Response, FileResponse, RedirectResponse
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    ClientError = None
+
+from config.settings import settings
+
+
+# The names never change their content
+CACHE_HEADERS = {'Cache-Control': 'public, max-age=31536000, immutable'}
+
+
+def shard(filename: str) -> str:
+    return f'{filename[:2]}/{filename[2:4]}/{filename}'
+
+
+def is_valid_filename(filename: str) -> bool:
+    return (
+        len(filename) > 4 and not filename.startswith('.')
+        and all(character.isalnum() or character in '._-' for character in filename)
+    )
+
+
+def flat_files(directory: str) -> Iterator[str]:
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and is_valid_filename(entry.name):
+                yield entry.name
+
+
+class LocalStorage:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.root, *shard(filename).split('/'))
+
+    def _find(self, filename: str) -> str | None:
+        for path in (self.path(filename), os.path.join(self.root, filename)):  # not migrated yet
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # Moves a local file into the storage, replacing a file with the same name
+    def save(self, local_path: str, filename: str) -> None:
+        path = self.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(local_path, path)
+
+    def exists(self, filename: str) -> bool:
+        return self._find(filename) is not None
+
+    def open(self, filename: str) -> BinaryIO:
+        path = self._find(filename)
+        if path is None:
+            raise FileNotFoundError(filename)
+        return open(path, 'rb')
+
+    def delete(self, filename: str) -> bool:
+        deleted = False
+        for path in (self.path(filename), os.path.join(self.root, filename)):
+            if os.path.isfile(path):
+                os.remove(path)
+                deleted = True
+        return deleted
+
+    # Moves the files out of reach without deleting them. Returns what unhide() needs to put them back.
+    def hide(self, filenames: list[str]) -> list[tuple[str, str]]:
+        hidden = []
+        for filename in filenames:
+            path = self._find(filename)
+            if path is None:
+                continue
+            tombstone = os.path.join(os.path.dirname(path), f'.{filename}.{uuid4()}.deleting')
+            try:
+                os.replace(path, tombstone)
+            except FileNotFoundError:
+                continue
+            hidden.append((path, tombstone))
+        return hidden
+
+    def unhide(self, hidden: list[tuple[str, str]], delete: bool) -> None:
+        for path, tombstone in hidden:
+            try:
+                if delete:
+                    os.remove(tombstone)
+                else:
+                    os.replace(tombstone, path)
+            except FileNotFoundError:  # removed as a leftover by the garbage collector
+                pass
+
+    # Every stored file as (location for remove(), filename, modification time, size), one directory at a time.
+    # Temporary uploads and tombstones are included, their names start with a dot. Renames keep the mtime,
+    # so the change time counts as a modification too.
+    def walk(self) -> Iterator[tuple[str, str, float, int]]:
+        directories = [self.root]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        yield entry.path, entry.name, max(stat.st_mtime, stat.st_ctime), stat.st_size
+
+    def remove(self, locations: list[str]) -> None:
+        for location in locations:
+            try:
+                os.remove(location)
+            except FileNotFoundError:
+                pass
+
+    def response(self, filename: str) -> Response | None:
+        path = self._find(filename)
+        if path is None:
+            return None
+        return FileResponse(path, headers=CACHE_HEADERS)
+
+
+def _is_missing(error: Exception) -> bool:
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3Storage:
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str | None = None, region: str | None = None,
+                 url_expire_seconds: int = 3600):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.url_expire_seconds = url_expire_seconds
+        self._client = None
+
+    # boto3 clients can't be pickled, the worker processes of the image pool create their own
+    def __getstate__(self):
+        return {**self.__dict__, '_client': None}
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('STORAGE_BACKEND=s3 needs boto3, pip install boto3')
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+        return self._client
+
+    def key(self, filename: str) -> str:
+        return f'{self.prefix}{shard(filename)}'
+
+    def save(self, local_path: str, filename: str) -> None:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.client.upload_file(local_path, self.bucket, self.key(filename), ExtraArgs={'ContentType': content_type})
+        os.remove(local_path)
+
+    def exists(self, filename: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(filename))
+        except ClientError as e:
+            if _is_missing(e):
+                return False
+            raise
+        return True
+
+    def open(self, filename: str) -> BinaryIO:
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(filename))['Body']
+        except ClientError as e:
+            if _is_missing(e):
+                raise FileNotFoundError(filename)
+            raise
+        return io.BytesIO(body.read())  # Pillow needs a seekable file
+
+    def delete(self, filename: str) -> bool:
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(filename))
+        return True
+
+    # Objects can't be renamed, they are copied next to the deleted objects and removed from their key
+    def hide(self, filenames: list[str]) -> list[tuple[str, str]]:
+        hidden = []
+        for filename in filenames:
+            key, tombstone = self.key(filename), f'{self.prefix}.deleting/{uuid4()}/{filename}'
+            try:
+                self.client.copy_object(
+                    Bucket=self.bucket, Key=tombstone, CopySource={'Bucket': self.bucket, 'Key': key}
+                )
+            except ClientError as e:
+                if _is_missing(e):
+                    continue
+                raise
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+            hidden.append((key, tombstone))
+        return hidden
+
+    def unhide(self, hidden: list[tuple[str, str]], delete: bool) -> None:
+        for key, tombstone in hidden:
+            if not delete:
+                self.client.copy_object(
+                    Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': tombstone}
+                )
+            self.client.delete_object(Bucket=self.bucket, Key=tombstone)
+
+    def walk(self) -> Iterator[tuple[str, str, float, int]]:
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for entry in page.get('Contents', []):
+                key = entry['Key']
+                filename = key.rsplit('/', 1)[-1]
+                if key.startswith(f'{self.prefix}.deleting/'):
+                    filename = f'.{filename}'  # tombstone
+                yield key, filename, entry['LastModified'].timestamp(), entry['Size']
+
+    def remove(self, locations: list[str]) -> None:
+        for start in range(0, len(locations), 1000):  # delete_objects takes at most 1000 keys
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in locations[start:start + 1000]], 'Quiet': True
+            })
+
+    # The client downloads the image from the bucket directly
+    def response(self, filename: str) -> Response | None:
+        url = self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(filename)}, ExpiresIn=self.url_expire_seconds
+        )
+        return RedirectResponse(url, headers={'Cache-Control': f'private, max-age={self.url_expire_seconds // 2}'})
+
+
+# The configured storage, created on first use
+@cache
+def get_storage() -> LocalStorage | S3Storage:
+    if settings.storage_backend == 's3':
+        return S3Storage(
+            settings.s3_bucket, settings.s3_prefix, settings.s3_endpoint_url, settings.s3_region,
+            settings.s3_url_expire_seconds
+        )
+    return LocalStorage(settings.upload_dir)
+
+
+# Moves the files stored flat in settings.upload_dir into the storage, `batch_size` files at a time spread over
+# `workers` threads (the work is mostly waiting for the disk or the bucket).
+def migrate_flat_files(workers: int = 8, batch_size: int = 1000) -> int:
+    storage = get_storage()
+
+    def migrate(filename: str):
+        try:
+            storage.save(os.path.join(settings.upload_dir, filename), filename)
+        except FileNotFoundError:  # listed twice while the directory changes under the listing
+            pass
+
+    migrated = 0
+    files = flat_files(settings.upload_dir)
+    with ThreadPoolExecutor(workers) as executor:
+        while batch := [filename for _, filename in zip(range(batch_size), files)]:
+            list(executor.map(migrate, batch))
+            migrated += len(batch)
+            print(f'Migrated {migrated} files')
+    return migrated